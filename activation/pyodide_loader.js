@@ -0,0 +1,59 @@
+// pyodide_loader.js
+
+// Loads the calculator into pyodide for webworker.js and sw.js, which
+// include it with importScripts after loading pyodide.js.  When it is
+// ready, self.pyodide is the pyodide instance and self.handle_js_request
+// runs the calculation for a request dict, returning the JSON response.
+
+// The python code is served as a single versioned bundle built by
+// build_bundle.py.  The manifest is small and always revalidated; the
+// bundle itself is named by its hash so the browser can cache it.
+const BUNDLE_DIR = "./bundle/";
+
+// Time in ms for each phase of loading, reported to the page when ready.
+const load_timings = {};
+async function timed(phase, fn) {
+  const start = performance.now();
+  const result = await fn();
+  load_timings[phase] = performance.now() - start;
+  return result;
+}
+
+async function fetchBundle(onManifest) {
+  const manifest = await (await fetch(BUNDLE_DIR + "manifest.json", {cache: "no-cache"})).json();
+  if (onManifest) {
+    await onManifest(manifest);
+  }
+  const response = await fetch(BUNDLE_DIR + manifest.bundle);
+  if (!response.ok) {
+    throw new Error(`Unable to load ${manifest.bundle}: ${response.status}`);
+  }
+  return await response.arrayBuffer();
+}
+
+// onManifest, if given, is called with the bundle manifest before the
+// bundle is fetched.
+async function loadPyodideAndPackages(onManifest) {
+  const start = performance.now();
+  // Fetch the bundle while pyodide is starting.
+  const bundle = timed("fetch_bundle", () => fetchBundle(onManifest));
+  const pyodide = await timed("load_pyodide", loadPyodide);
+  await timed("load_numpy", () => pyodide.loadPackage(["numpy"]));
+  const data = await bundle;
+  await timed("unpack_bundle", () => pyodide.unpackArchive(data, "zip"));
+  await timed("import_nact", () => pyodide.runPythonAsync(`
+    import json
+    import nact
+
+    def handle_js_request(request):
+        """Run the calculation for a request dict, returning JSON."""
+        form = nact.FakeFieldStorage(request)
+        return json.dumps(nact.handle_request(form))
+
+    print(nact.periodictable.__version__)
+  `));
+  self.handle_js_request = pyodide.globals.get("handle_js_request");
+  await timed("warmup", () => pyodide.runPythonAsync("nact.warmup()"));
+  load_timings.total = performance.now() - start;
+  self.pyodide = pyodide;
+}
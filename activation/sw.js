@@ -7,45 +7,129 @@ importScripts("https://cdn.jsdelivr.net/npm/xhr-shim@0.1.3/src/index.js");
 self.XMLHttpRequest = self.XMLHttpRequestShim;
 importScripts("https://cdn.jsdelivr.net/pyodide/v0.20.0/full/pyodide.js");
 
-let pyodide = null;
-
-async function loadPyodideAndPackages() {
-  const pyodide = await loadPyodide();
-  await pyodide.loadPackage(["numpy", "pytz", "micropip"]);
-  await pyodide.runPythonAsync(`
-    import micropip
-    await micropip.install("periodictable")
-    import periodictable
-    print(periodictable.__version__)
-  `)
-
-  // Downloading a single file
-  await pyodide.runPythonAsync(`
-    from pyodide.http import pyfetch
-    response = await pyfetch("../cgi-bin/nact.py")
-    with open("nact.py", "wb") as f:
-        f.write(await response.bytes())
-    import nact
-    import json
-    import re
-
-    class FakeFieldStorage(dict):
-        def getfirst(self, name, default=None):
-            rval = self.get(name, default)
-            return rval if rval != "" else default
-        def getlist(self, name, default=None):
-            name = re.sub("\\[\\]$", "", name)
-            rval = self.get(name, default)
-            if isinstance(rval, str) or isinstance(rval, bytes):
-                return [rval]
-            return list(rval)
-  `);
-  self.pyodide = pyodide;
+importScripts("./pyodide_loader.js");
+
+// Calculation results are kept in Cache Storage, keyed by a hash of the
+// normalized request, so that repeated requests are answered without
+// running the calculation, including after the page is reloaded.  The
+// index of cached results with their size and time of last use is stored
+// in the same cache, and the least recently used results are dropped when
+// the total size exceeds RESULT_CACHE_BYTES.  Results are only valid for
+// the bundle which computed them, so the cache is cleared when the bundle
+// changes.  Requests with rest times given as dates depend on the current
+// time and are not cached.
+const RESULT_CACHE = "nact-results";
+const RESULT_CACHE_BYTES = 20*1024*1024;
+const RESULT_PATH = "./nact-results/";
+let result_index = null;  // {bundle: sha256, entries: {hash: {size, used}}}
+let result_index_saved = Promise.resolve();
+
+async function open_result_index() {
+  if (result_index === null) {
+    const cache = await caches.open(RESULT_CACHE);
+    const response = await cache.match(RESULT_PATH + "index.json");
+    result_index = response ? await response.json() : { bundle: null, entries: {} };
+  }
+  return result_index;
+}
+
+function save_result_index() {
+  // Chain the writes so that they are stored in order.
+  result_index_saved = result_index_saved.then(async () => {
+    const cache = await caches.open(RESULT_CACHE);
+    await cache.put(RESULT_PATH + "index.json", new Response(JSON.stringify(result_index)));
+  });
+  return result_index_saved;
+}
+
+async function check_result_cache(bundle) {
+  const index = await open_result_index();
+  if (index.bundle !== bundle) {
+    await caches.delete(RESULT_CACHE);
+    result_index = { bundle: bundle, entries: {} };
+    await save_result_index();
+  }
+}
+
+function is_date(value) {
+  // Same test as nact.is_date.
+  return typeof value === "string" && (value.includes("-") || value.includes(":"));
+}
+
+function is_cacheable(data) {
+  const rest = [].concat(data.rest ?? [], data["rest[]"] ?? []);
+  return !rest.some(is_date) && !data.debug;
+}
+
+function normalize_request(data) {
+  // Sort the fields and drop empty ones, which the calculator ignores.
+  if (Array.isArray(data)) {
+    return data.map(normalize_request);
+  }
+  if (data === null || typeof data !== "object") {
+    return data;
+  }
+  const result = {};
+  for (const key of Object.keys(data).sort()) {
+    if (data[key] !== "" && data[key] !== null && data[key] !== undefined) {
+      result[key] = normalize_request(data[key]);
+    }
+  }
+  return result;
+}
+
+async function request_hash(data) {
+  const text = JSON.stringify(normalize_request(data));
+  const digest = await crypto.subtle.digest("SHA-256", new TextEncoder().encode(text));
+  return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, "0")).join("");
+}
+
+async function cached_result(hash) {
+  const index = await open_result_index();
+  const entry = index.entries[hash];
+  if (!entry) {
+    return null;
+  }
+  const cache = await caches.open(RESULT_CACHE);
+  const response = await cache.match(RESULT_PATH + hash);
+  if (!response) {
+    // Evicted by the browser; drop it from the stored index as well.
+    delete index.entries[hash];
+    save_result_index();
+    return null;
+  }
+  entry.used = Date.now();
+  save_result_index();
+  return await response.text();
+}
+
+async function store_result(hash, results) {
+  const index = await open_result_index();
+  const cache = await caches.open(RESULT_CACHE);
+  await cache.put(RESULT_PATH + hash, new Response(results));
+  index.entries[hash] = { size: results.length, used: Date.now() };
+  // Evict the least recently used results until the cache fits.
+  const entries = Object.entries(index.entries).sort((a, b) => a[1].used - b[1].used);
+  let total = entries.reduce((sum, [, entry]) => sum + entry.size, 0);
+  for (const [key, entry] of entries) {
+    if (total <= RESULT_CACHE_BYTES) {
+      break;
+    }
+    total -= entry.size;
+    delete index.entries[key];
+    await cache.delete(RESULT_PATH + key);
+  }
+  await save_result_index();
+}
+
+function load_calculator() {
+  // Stored results are cleared if the bundle has changed.
+  return loadPyodideAndPackages((manifest) => check_result_cache(manifest.sha256));
 }
 
 self.addEventListener("install", () => {
   self.skipWaiting();
-  self.pyodideReadyPromise = loadPyodideAndPackages();
+  self.pyodideReadyPromise = load_calculator();
   self.pyodideReadyPromise.then(() => {
     console.log("install finished from sw.js side");
   });
@@ -73,25 +157,39 @@ self.addEventListener("fetch", (event) => {
 
 async function make_ready() {
   if (!self?.pyodide?.runPythonAsync) {
-    const pyodideReadyPromise = loadPyodideAndPackages();
+    const pyodideReadyPromise = load_calculator();
     await pyodideReadyPromise;
   }
-  return new Response("true", { headers: { 'Content-Type': 'application/json' } });
+  return new Response(JSON.stringify({ready: true, timings: load_timings}),
+                      { headers: { 'Content-Type': 'application/json' } });
 }
 
 async function do_calculation(event) {
+  let request = null;
   try {
-    const json_data = await event.request.text();
-    let python = `
-      request = json.loads('${json_data}')
-      form = FakeFieldStorage(request)
-      json.dumps(nact.cgi_call(form))
-    `;
-    let results = await self.pyodide.runPythonAsync(python);
+    const data = await event.request.json();
+    const hash = is_cacheable(data) ? await request_hash(data) : null;
+    if (hash !== null) {
+      const cached = await cached_result(hash);
+      if (cached !== null) {
+        return new Response(cached, { headers: {
+          'Content-Type': 'application/json', 'X-Result-Cache': 'hit' } });
+      }
+    }
+    request = self.pyodide.toPy(data);
+    const results = self.handle_js_request(request);
+    if (hash !== null && JSON.parse(results).success) {
+      event.waitUntil(store_result(hash, results));
+    }
     return new Response(results, { headers: { 'Content-Type': 'application/json' } });
   }
   catch (error) {
     const edata = JSON.stringify({ success: false, detail: {error: error.message }});
     return new Response(edata, {headers: {'Content-Type': 'application/json'}});
   }
-}
\ No newline at end of file
+  finally {
+    if (request) {
+      request.destroy();
+    }
+  }
+}
@@ -6,59 +6,65 @@
 importScripts("https://cdn.jsdelivr.net/pyodide/v0.26.0/full/pyodide.js");
 // importScripts("./pyodide/pyodide.js");
 
-async function loadPyodideAndPackages() {
-  self.pyodide = await loadPyodide();
-  await self.pyodide.loadPackage(["numpy", "pytz", "micropip"]);
-  await self.pyodide.runPythonAsync(`
-    import micropip
-    await micropip.install("periodictable")
-    import periodictable
-    print(periodictable.__version__)
-  `)
+importScripts("./pyodide_loader.js");
 
-  // Downloading a single file
-  await pyodide.runPythonAsync(`
-    from pyodide.http import pyfetch
-    response = await pyfetch("../cgi-bin/nact.py")
-    with open("nact.py", "wb") as f:
-        f.write(await response.bytes())
-    import nact
-    import json
-    import re
+let pyodideReadyPromise = loadPyodideAndPackages();
+pyodideReadyPromise.then(() => self.postMessage({worker_ready: true, timings: load_timings}));
+
+// Requests are posted as {id, data} and answered with {id, result}.  The
+// calculation blocks the worker, so requests received while it is busy
+// are queued.  A new request replaces any queued requests that have not
+// started, and {cancel: id} withdraws a queued request.  Replaced and
+// cancelled requests are answered with {id, cancelled: true}.
+const request_queue = [];
+let queue_running = false;
+
+self.onmessage = (event) => {
+  const message = event.data;
+  if ('cancel' in message) {
+    const index = request_queue.findIndex((item) => item.id === message.cancel);
+    if (index >= 0) {
+      cancel_request(request_queue.splice(index, 1)[0]);
+    }
+    return;
+  }
+  while (request_queue.length) {
+    cancel_request(request_queue.shift());
+  }
+  request_queue.push(message);
+  if (!queue_running) {
+    queue_running = true;
+    // Let any messages which arrived during the last calculation be
+    // delivered before starting the next one.
+    setTimeout(run_queue, 0);
+  }
+};
 
-    class FakeFieldStorage(dict):
-        def getfirst(self, name, default=None):
-            rval = self.get(name, default)
-            return rval if rval != "" else default
-        def getlist(self, name, default=None):
-            name = re.sub("\\[\\]$", "", name)
-            rval = self.get(name, default)
-            if isinstance(rval, str) or isinstance(rval, bytes):
-                return [rval]
-            return list(rval)
-  `)
+function cancel_request(item) {
+  self.postMessage({ id: item.id, cancelled: true });
 }
-let pyodideReadyPromise = loadPyodideAndPackages();
-pyodideReadyPromise.then(() => self.postMessage({worker_ready: true}));
 
-self.onmessage = async (event) => {
-  // make sure loading is done
+async function run_queue() {
   await pyodideReadyPromise;
-  // Don't bother yet with this line, suppose our API is built in such a way:
-  const { request } = event.data;
-  const json_data = JSON.stringify(event.data.data);
-  // Now is the easy part, the one that is similar to working in the main thread:
+  while (request_queue.length) {
+    const item = request_queue.shift();
+    self.postMessage({ id: item.id, result: calculate(item.data) });
+    // Yield so that new requests and cancellations can be received.
+    await new Promise((resolve) => setTimeout(resolve, 0));
+  }
+  queue_running = false;
+}
+
+function calculate(data) {
+  let request = null;
   try {
-    let python = `
-      request = json.loads('${json_data}')
-      form = FakeFieldStorage(request)
-      json.dumps(nact.cgi_call(form))
-    `;
-    //console.log('python:', python);
-    let results = await self.pyodide.runPythonAsync(python);
-    let ldata = JSON.parse(results);
-    self.postMessage(ldata);
+    request = self.pyodide.toPy(data);
+    return JSON.parse(self.handle_js_request(request));
   } catch (error) {
-    self.postMessage({ success: false, detail: {error: error.message }});
+    return { success: false, detail: {error: error.message }};
+  } finally {
+    if (request) {
+      request.destroy();
+    }
   }
-};
\ No newline at end of file
+}
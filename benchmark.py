@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Benchmark the activation calculator over a representative set of samples.
+
+Usage: python benchmark.py [--repeat N] [--cached] [--digits N]
+                           [--output results.json] [--compare previous.json]
+
+Each sample in CORPUS is sent to nact.cgi_call using nact.FakeFieldStorage,
+the same way the in-browser calculator drives it.  The request and each
+of its sections (activation, scattering, xray_scattering) are timed, and
+the 50th, 95th and 99th percentile times are reported over all samples
+and repeats.  The peak memory allocated by python (from tracemalloc) for
+each section is measured in a separate pass, since tracing slows the
+calculation.  Sections answered from the result cache are not run, so
+they have no timing or memory entries.
+
+By default the result and formula caches are cleared before each request
+so that the full calculation is measured.  Use --cached to leave the
+caches in place, which measures the repeated request path instead.
+
+The size of the encoded responses for the corpus is compared between the
+original encoding (json.dumps followed by html.escape), nact.json_encode
+at full precision, and nact.json_encode with the activity levels rounded
+to --digits significant digits (default 4).
+
+The results are written as JSON (default benchmark.json) along with the
+python, numpy and periodictable versions, so that runs before and after
+an upgrade or a code change can be compared with --compare.
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import json
+import platform
+import tracemalloc
+from copy import deepcopy
+from collections import OrderedDict
+from html import escape
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "cgi-bin"))
+import nact
+
+SECTIONS = ["activation", "scattering", "xray_scattering"]
+SECTION_FUNCTIONS = {
+    "activation": "activation_section",
+    "scattering": "scattering_section",
+    "xray_scattering": "xray_section",
+}
+
+LONG_REST = ["%gh" % (1.5**k) for k in range(-10, 30)]
+
+# (group, fields) for each request in the benchmark.
+CORPUS = [
+    # simple elements
+    ("element", {"sample": "Co"}),
+    ("element", {"sample": "Au", "mass": "10g"}),
+    ("element", {"sample": "Gd"}),
+    ("element", {"sample": "U"}),
+    ("element", {"sample": "Fe", "fast": "0.1", "Cd": "20"}),
+    # hydrated minerals
+    ("mineral", {"sample": "CuSO4(H2O)5"}),
+    ("mineral", {"sample": "CaSO4(H2O)2"}),
+    ("mineral", {"sample": "Na2B4O7(H2O)10"}),
+    ("mineral", {"sample": "Al2Si2O5(OH)4", "density": "2.6"}),
+    # multi-component alloys
+    ("alloy", {"sample": "Fe70Cr18Ni10Mn2", "mass": "5g"}),
+    ("alloy", {"sample": "Ni58Cr21.5Mo13.5W3Fe3"}),
+    ("alloy", {"sample": "Ti90Al6V4", "exposure": "10h"}),
+    # isotope labelled formulas
+    ("isotope", {"sample": "H[2]2O"}),
+    ("isotope", {"sample": "B[10]4C"}),
+    ("isotope", {"sample": "Li[6]F"}),
+    ("isotope", {"sample": "C[13]H4"}),
+    # mixtures by weight
+    ("mixture", {"sample": "20%wt D2O // H2O"}),
+    ("mixture", {"sample": "5%wt NaCl // H2O"}),
+    ("mixture", {"sample": "50%wt Fe // 30%wt Ni // Cr"}),
+    # long rest time lists
+    ("rest", {"sample": "Co", "rest[]": LONG_REST}),
+    ("rest", {"sample": "Fe70Cr18Ni10Mn2", "rest[]": LONG_REST, "decay": "1e-3,1e-4,1e-5"}),
+]
+
+def percentile(values, p):
+    """Percentile *p* of *values* using linear interpolation."""
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1)*p/100.
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo])*(k - lo)
+
+def summarize(times):
+    return OrderedDict([
+        ("n", len(times)),
+        ("p50", percentile(times, 50)),
+        ("p95", percentile(times, 95)),
+        ("p99", percentile(times, 99)),
+        ("mean", sum(times)/len(times) if times else None),
+    ])
+
+class SectionProbe(object):
+    """
+    Replace the nact section functions with wrappers that record the time
+    taken, and optionally the peak traced memory, for each call.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.times = dict((name, []) for name in SECTIONS)
+        self.peak = dict((name, None) for name in SECTIONS)
+        self._saved = {}
+
+    def __enter__(self):
+        # Run the sections one at a time in this thread so that they are
+        # timed and traced separately.
+        self._saved["SECTION_THREADS"] = nact.SECTION_THREADS
+        nact.SECTION_THREADS = False
+        for name, attr in SECTION_FUNCTIONS.items():
+            self._saved[attr] = getattr(nact, attr)
+            setattr(nact, attr, self._wrap(name, self._saved[attr]))
+        return self
+
+    def __exit__(self, *args):
+        for attr, value in self._saved.items():
+            setattr(nact, attr, value)
+
+    def _wrap(self, name, fn):
+        def probe(*args):
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            result = fn(*args)
+            self.times[name].append(time.perf_counter() - start)
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                self.peak[name] = max(self.peak[name] or 0, peak)
+            return result
+        return probe
+
+def run_request(fields, cached):
+    if not cached:
+        nact.result_cache.clear()
+        nact.formula_cache.clear()
+    result = nact.cgi_call(nact.FakeFieldStorage(fields))
+    if not result.get("success", False):
+        raise RuntimeError("benchmark request %r failed: %s" % (fields, result))
+    return result
+
+def legacy_encode(result):
+    """The response encoding used before nact.json_encode."""
+    return escape(json.dumps(result), quote=False)
+
+def measure_encoding(digits=4, repeat=5):
+    """
+    Total encoded size in bytes and encoding time for the corpus responses
+    using each encoding.
+    """
+    results = [run_request(fields, cached=True) for _, fields in CORPUS]
+    rounded = [nact.round_levels(deepcopy(result), digits) for result in results]
+    encoders = [
+        ("legacy", legacy_encode, results),
+        ("compact", nact.json_encode, results),
+        ("digits=%d" % digits, nact.json_encode, rounded),
+    ]
+    table = OrderedDict()
+    for name, encode, data in encoders:
+        size = sum(len(encode(result)) for result in data)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for result in data:
+                encode(result)
+            times.append(time.perf_counter() - start)
+        table[name] = OrderedDict([
+            ("bytes", size),
+            ("saving", 1 - size/table["legacy"]["bytes"] if table else 0.),
+            ("seconds", min(times)),
+        ])
+    return table
+
+def run_benchmark(repeat=20, cached=False, digits=4):
+    """
+    Run the corpus *repeat* times and return the benchmark results.
+    """
+    # Load the tables so that the first request is not an outlier.
+    nact.warmup()
+
+    requests = []
+    groups = OrderedDict()
+    with SectionProbe() as probe:
+        for _ in range(repeat):
+            for group, fields in CORPUS:
+                start = time.perf_counter()
+                run_request(fields, cached)
+                elapsed = time.perf_counter() - start
+                requests.append(elapsed)
+                groups.setdefault(group, []).append(elapsed)
+    timing = probe.times
+
+    tracemalloc.start()
+    try:
+        with SectionProbe(trace_memory=True) as probe:
+            for group, fields in CORPUS:
+                run_request(fields, cached)
+    finally:
+        tracemalloc.stop()
+    peak = probe.peak
+
+    sections = OrderedDict()
+    sections["request"] = summarize(requests)
+    for name in SECTIONS:
+        sections[name] = summarize(timing[name])
+        sections[name]["peak_bytes"] = peak[name]
+    return OrderedDict([
+        ("environment", OrderedDict([
+            ("python", platform.python_version()),
+            ("numpy", nact.np.__version__),
+            ("periodictable", nact.periodictable.__version__),
+            ("orjson", nact.orjson.__version__ if nact.orjson else None),
+            ("platform", platform.platform()),
+        ])),
+        ("settings", {"repeat": repeat, "cached": cached, "digits": digits,
+                      "samples": len(CORPUS)}),
+        ("sections", sections),
+        ("groups", OrderedDict((group, summarize(times))
+                               for group, times in groups.items())),
+        ("encoding", measure_encoding(digits)),
+    ])
+
+def print_results(results, previous=None):
+    header = "%-16s %8s %8s %8s %10s" % ("section", "p50 ms", "p95 ms", "p99 ms", "peak kB")
+    if previous is not None:
+        header += " %9s" % "p50 ratio"
+    print(header)
+    for table in ("sections", "groups"):
+        for name, stats in results[table].items():
+            peak = stats.get("peak_bytes")
+            line = "%-16s %8.3f %8.3f %8.3f %10s" % (
+                name, 1e3*stats["p50"], 1e3*stats["p95"], 1e3*stats["p99"],
+                "%.1f" % (peak/1024) if peak is not None else "")
+            old = previous.get(table, {}).get(name) if previous else None
+            if old:
+                line += " %9.2f" % (stats["p50"]/old["p50"])
+            print(line)
+        if table == "sections":
+            print()
+    print()
+    print("%-16s %10s %8s %10s" % ("encoding", "kB", "saving", "ms"))
+    for name, stats in results.get("encoding", {}).items():
+        print("%-16s %10.1f %7.1f%% %10.3f" % (
+            name, stats["bytes"]/1024, 100*stats["saving"], 1e3*stats["seconds"]))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark nact.cgi_call over a sample corpus.")
+    parser.add_argument("--repeat", type=int, default=20,
+        help="number of passes through the corpus (default 20)")
+    parser.add_argument("--cached", action="store_true",
+        help="keep the result and formula caches between requests")
+    parser.add_argument("--digits", type=int, default=4,
+        help="significant digits for the rounded encoding (default 4)")
+    parser.add_argument("--output", default="benchmark.json",
+        help="file for the JSON results (default benchmark.json)")
+    parser.add_argument("--compare",
+        help="results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmark(repeat=args.repeat, cached=args.cached,
+                            digits=args.digits)
+    previous = None
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+    print_results(results, previous)
+    with open(args.output, "w") as fd:
+        json.dump(results, fd, indent=2)
+        fd.write("\n")
+
+if __name__ == "__main__":
+    main()
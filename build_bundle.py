@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Build the python bundle for the in-browser (pyodide) calculator.
+
+Usage: python build_bundle.py [--output activation/bundle]
+
+The bundle is a single zip file holding the calculator scripts (nact.py and
+massfrac.py) along with the pure python packages they need (periodictable,
+including its data tables, pyparsing and pytz), laid out as a site-packages
+directory.  The web workers fetch and unpack it in one request instead of
+installing periodictable with micropip and fetching the scripts one by one.
+numpy is compiled, so it is still loaded from the pyodide distribution.
+
+The packages are copied from the python environment running this script,
+so install the versions you want to ship first, e.g.::
+
+    pip install periodictable pyparsing pytz
+
+The zip file is named by the hash of its contents so that it can be cached
+indefinitely by the browser.  The workers find the current bundle from
+manifest.json in the same directory, which also records the package
+versions.  Old bundles are removed when a new one is built.
+"""
+
+from __future__ import print_function
+
+import os
+import io
+import json
+import hashlib
+import zipfile
+from importlib import metadata
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = ["cgi-bin/nact.py", "cgi-bin/massfrac.py"]
+PACKAGES = ["periodictable", "pyparsing", "pytz"]
+DEFAULT_OUTPUT = os.path.join(ROOT, "activation", "bundle")
+
+# Fixed timestamp for zip entries so that the bundle hash only depends on
+# the file contents.
+ZIP_DATE = (2020, 1, 1, 0, 0, 0)
+
+def package_files(name):
+    """
+    Return [(archive path, file path)] for the installed distribution *name*.
+
+    Raises RuntimeError if the distribution contains compiled extensions,
+    which cannot be loaded by pyodide.
+    """
+    dist = metadata.distribution(name)
+    files = []
+    for path in dist.files or []:
+        parts = path.parts
+        if "__pycache__" in parts or path.suffix in (".pyc", ".pyo"):
+            continue
+        if parts[0].startswith("..") or path.name == "RECORD":
+            # Scripts installed outside site-packages and the install record
+            continue
+        if path.suffix in (".so", ".pyd", ".dylib"):
+            raise RuntimeError("%s is not pure python (%s)" % (name, path))
+        files.append(("/".join(parts), str(path.locate())))
+    return dist.version, files
+
+def build_zip(entries):
+    """Return the zip file contents for [(archive path, file path)]."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+        for arcname, filename in sorted(entries):
+            info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(filename, "rb") as fd:
+                zf.writestr(info, fd.read())
+    return buffer.getvalue()
+
+def build_bundle(output=DEFAULT_OUTPUT):
+    """
+    Write the bundle and its manifest to the *output* directory, returning
+    the manifest.
+    """
+    entries = [(os.path.basename(path), os.path.join(ROOT, path))
+               for path in SCRIPTS]
+    versions = {}
+    for name in PACKAGES:
+        versions[name], files = package_files(name)
+        entries.extend(files)
+    data = build_zip(entries)
+    digest = hashlib.sha256(data).hexdigest()
+    filename = "nact-bundle-%s.zip" % digest[:12]
+
+    os.makedirs(output, exist_ok=True)
+    for old in os.listdir(output):
+        if old.startswith("nact-bundle-") and old != filename:
+            os.remove(os.path.join(output, old))
+    with open(os.path.join(output, filename), "wb") as fd:
+        fd.write(data)
+    manifest = {
+        "bundle": filename,
+        "sha256": digest,
+        "size": len(data),
+        "files": len(entries),
+        "packages": versions,
+        "scripts": [os.path.basename(path) for path in SCRIPTS],
+    }
+    with open(os.path.join(output, "manifest.json"), "w") as fd:
+        json.dump(manifest, fd, indent=2)
+        fd.write("\n")
+    return manifest
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the python bundle for the pyodide calculator.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+        help="directory for the bundle (default activation/bundle)")
+    args = parser.parse_args()
+    manifest = build_bundle(args.output)
+    print("wrote %s (%d files, %.1f kB)" % (
+        os.path.join(args.output, manifest["bundle"]),
+        manifest["files"], manifest["size"]/1024))
+    for name, version in sorted(manifest["packages"].items()):
+        print("  %s %s" % (name, version))
+
+if __name__ == "__main__":
+    main()
@@ -4,58 +4,102 @@
 import cgi
 import traceback
 import sys
-import json
-from html import escape
 
-from periodictable import formula
+# Formulas are parsed with the activation calculator so that they share its
+# formula cache when both scripts run in the same process (server.py --app).
+import nact
 
 DEBUG = False
 
+# Maximum number of formulas in a batch request.
+MAX_FORMULAS = 1000
+
 def error():
     if DEBUG:
         return traceback.format_exc()
     else:
         return str(sys.exc_info()[1])
 
+# Responses use the activation calculator encoder, which escapes "&", "<"
+# and ">" in strings as a cross-site scripting (XSS) defense.
+json_encode = nact.json_encode
+
 def respond(result):
-    jsonstr = json.dumps(result)
-    # Cross-site scripting (XSS) defense. There is no reason for the returned
-    # JSON strings to include an unescaped "<" character, so if one slips
-    # through from malicious inputs or from code in an error traceback it will
-    # be sanitized here. Note that this is not true in general; if your web
-    # service returns html strings instead of adding markup in the browser,
-    # then you will need to sanitize the inputs instead of the outputs.
-    jsonstr = escape(jsonstr, quote=False)
+    jsonstr = json_encode(result)
     #print(jsonstr, file=sys.stderr)
     print("Content-Type: application/json; charset=UTF-8")
     print("Access-Control-Allow-Origin: *")
     print("Content-Length: %d\n"%(len(jsonstr)+1))
     print(jsonstr)
 
-def cgi_call():
-    form = cgi.FieldStorage()
+def mass_fractions(sample):
+    _, derived = nact.parse_formula(sample)
+    return dict([(str(k), v) for k,v in derived['mass_fraction'].items()])
+
+def cgi_call(form):
     #print(form, file=sys.stderr)
     #print >>sys.stderr, "sample",form.getfirst('sample')
     #print >>sys.stderr, "mass",form.getfirst('mass')
+    if form.getfirst('formulas') is not None:
+        return batch_call(form)
 
     # Parse inputs
     errors = {}
     sample = form.getfirst('sample')
-    chem = formula(sample)
-    mass_fraction = chem.mass_fraction
-    mass_fraction = dict([(str(k), v) for k,v in mass_fraction.items()])
     result = {'success': True}
-    result['mass_fractions'] = mass_fraction
+    result['mass_fractions'] = mass_fractions(sample)
 
     return result
 
-if __name__ == "__main__":
+def batch_call(form):
+    """
+    Mass fractions for many formulas in one request.
+
+    The *formulas* field has one formula per line, such as a sample
+    manifest pasted from a spreadsheet.  Blank lines and lines starting
+    with "#" are skipped.  Each formula gets its own result, so an error
+    in one does not affect the others.
+    """
+    lines = form.getfirst('formulas').splitlines()
+    samples = [line.strip() for line in lines]
+    samples = [v for v in samples if v and not v.startswith('#')]
+    if len(samples) > MAX_FORMULAS:
+        return {
+            'success': False,
+            'error': 'invalid request',
+            'detail': {'formulas': "limited to %d formulas"%MAX_FORMULAS},
+        }
+    results = []
+    for sample in samples:
+        try:
+            results.append({
+                'success': True,
+                'sample': sample,
+                'mass_fractions': mass_fractions(sample),
+            })
+        except Exception:
+            results.append({
+                'success': False,
+                'sample': sample,
+                'error': 'invalid formula',
+                'detail': {'sample': error()},
+            })
+    return {'success': True, 'samples': results}
+
+def handle_request(form):
+    """
+    Run the calculation for *form*, turning unexpected exceptions into
+    an error response.
+    """
     try:
-        response = cgi_call()
+        return cgi_call(form)
     except Exception:
-        response = {
+        return {
             'success':False,
             'error': 'unexpected exception',
             'detail':{'query': error()},
         }
-    respond(response)
\ No newline at end of file
+
+if __name__ == "__main__":
+    form = cgi.FieldStorage()
+    respond(handle_request(form))
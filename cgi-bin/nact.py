@@ -8,11 +8,16 @@
 from __future__ import print_function
 
 import sys
-import cgi
 import re
 import json
-from math import exp
+import importlib
+from math import exp, log
 import traceback
+import threading
+import time
+from copy import copy, deepcopy
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from calendar import monthrange
 
@@ -22,11 +27,61 @@ try:
 except ImportError:
     from cgi import escape
 
-from pytz import timezone, utc
+# orjson is used to encode responses if it is available.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Time spent importing modules and loading data tables, recorded by the
+# section of the response which first needed them.  The periodictable
+# modules for each section (activation, neutron and xray scattering) and
+# pytz for beam off dates are only imported when they are used, so that a
+# cold start only pays for the tables that the request needs.
+LOAD_TIMES = OrderedDict()
+_loaded_tables = set()
+_load_lock = threading.Lock()
+
+def record_load(section, name, seconds):
+    """Record the time to load module or table *name* for *section*."""
+    with _load_lock:
+        LOAD_TIMES.setdefault(section, OrderedDict())[name] = seconds
+
+def load_module(section, name):
+    """
+    Import module *name*, recording the import time against *section* if
+    it was not already loaded.
+    """
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        record_load(section, name, time.perf_counter() - start)
+    return module
+
+def load_table(section, name, loader):
+    """
+    Call *loader* to load table *name* for *section* if it has not already
+    been loaded, recording the time taken.
+    """
+    if name not in _loaded_tables:
+        start = time.perf_counter()
+        loader()
+        record_load(section, name, time.perf_counter() - start)
+        _loaded_tables.add(name)
+
+def load_report():
+    """
+    Load times in seconds for the modules and tables used so far by this
+    process, as {section: {name: seconds}}.
+    """
+    with _load_lock:
+        return dict((section, dict(times)) for section, times in LOAD_TIMES.items())
 
-import periodictable
-from periodictable import elements, activation, formula, \
-        neutron_scattering, xray_sld, nsf, util, xsf
+np = load_module('startup', 'numpy')
+periodictable = load_module('startup', 'periodictable')
+from periodictable import elements, util
+from periodictable.core import isisotope
 
 
 ISO8601_RELAXED = re.compile(r"""^ # anchor to start of string
@@ -56,11 +111,55 @@ ISO8601_RELAXED = re.compile(r"""^ # anchor to start of string
   """, re.VERBOSE)
 
 # Default to the time zone is that for the NCNR.
-default_timezone = timezone('US/Eastern')
+DEFAULT_TIMEZONE = 'US/Eastern'
 
 #DEBUG = True
 DEBUG = False
 
+# Number of sample results to keep in the result cache.  The cache only
+# helps when the calculator is running in a long-lived process (see the
+# --app option in server.py); each cgi request starts with an empty cache.
+RESULT_CACHE_SIZE = 512
+
+# Number of parsed sample formulas to keep in the formula cache.
+FORMULA_CACHE_SIZE = 1024
+
+# The activation, neutron scattering and xray scattering sections of the
+# response are computed concurrently on a shared pool of SECTION_WORKERS
+# threads.  A section that takes longer than SECTION_TIMEOUT seconds is
+# reported as an error so that it does not hold back the other sections.
+# The timed out calculation keeps its worker until it finishes, so there
+# are at most SECTION_WORKERS abandoned sections at a time.  When all
+# workers are busy, new sections are computed in the request thread
+# without a timeout rather than waiting in the pool queue.
+SECTION_WORKERS = 8
+SECTION_TIMEOUT = 30.
+# Pyodide cannot start threads, so the sections are computed in turn.
+SECTION_THREADS = sys.platform not in ('emscripten', 'wasi')
+# As a cgi script each section runs on a daemon thread of its own, so that
+# a timed out section does not keep the process alive after the response.
+SECTION_DAEMON = False
+
+# Maximum number of points allowed on the decay curve time grid.
+MAX_CURVE_POINTS = 10000
+
+# Maximum number of (flux, exposure, fast, Cd) combinations in a sweep.
+MAX_SWEEP_POINTS = 1000
+
+# Maximum number of sample records in a batch request.
+MAX_SAMPLES = 1000
+
+# Form fields which may be swept, with the condition they set, their
+# default and the parser for each value.
+SWEEP_AXES = (
+    ('flux', 'fluence', '100000', float),
+    ('exposure', 'exposure', '1', None),  # parse_hours
+    ('fast', 'fast_ratio', '0', float),
+    ('Cd', 'Cd_ratio', '0', float),
+)
+
+LN2 = log(2)
+
 #import nsf_sears
 
 
@@ -150,22 +249,203 @@ def _lattice_key_sub(v):
         return 'gamma'
     return v.lower()
 
+# Cross-site scripting (XSS) defense. There is no reason for the returned
+# JSON strings to include an unescaped "<" character, so if one slips
+# through from malicious inputs or from code in an error traceback it will
+# be sanitized by the encoder. Note that this is not true in general; if your
+# web service returns html strings instead of adding markup in the browser,
+# then you will need to sanitize the inputs instead of the outputs.
+#
+# The escapes are the same as html.escape(quote=False) applied to the
+# whole response, but are made to each string as it is encoded.  Numbers,
+# separators and JSON string escapes never contain "&", "<" or ">".
+def _encode_string(s):
+    s = json.encoder.encode_basestring_ascii(s)
+    if '&' in s:
+        s = s.replace('&', '&amp;')
+    if '<' in s:
+        s = s.replace('<', '&lt;')
+    if '>' in s:
+        s = s.replace('>', '&gt;')
+    return s
+
+def _encode_default(obj):
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % type(obj).__name__)
+
+# CRUFT: python implementations without the C accelerated encoder fall
+# back to json.dumps followed by html.escape.
+_c_make_encoder = getattr(json.encoder, 'c_make_encoder', None)
+if _c_make_encoder is not None:
+    _stdlib_encoder = _c_make_encoder(
+        None, _encode_default, _encode_string, None, ':', ',',
+        False, False, True)
+else:
+    _stdlib_encoder = None
+
+def _json_encode_stdlib(result):
+    if _stdlib_encoder is None:
+        return escape(json.dumps(result, separators=(',', ':')), quote=False)
+    return ''.join(_stdlib_encoder(result, 0))
+
+def _json_encode_orjson(result):
+    try:
+        data = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY)
+    except TypeError:
+        # Dictionary keys which are not strings, integers beyond 64 bits, etc.
+        return None
+    if not data.isascii():
+        # Keep the response ASCII so that Content-Length counts characters.
+        return None
+    # orjson has no hook for string encoding, so check the encoded bytes.
+    # These are rare, so the replacements are almost never made.
+    if b'&' in data:
+        data = data.replace(b'&', b'&amp;')
+    if b'<' in data:
+        data = data.replace(b'<', b'&lt;')
+    if b'>' in data:
+        data = data.replace(b'>', b'&gt;')
+    return data.decode('ascii')
+
+def json_encode(result):
+    """
+    Encode *result* as compact JSON with "&", "<" and ">" in strings
+    replaced by html entities.
+
+    Uses orjson if it is installed.  orjson writes NaN and infinity as
+    null, and is skipped for results it cannot encode as ASCII.
+    """
+    start = time.perf_counter()
+    jsonstr = _json_encode_orjson(result) if orjson is not None else None
+    if jsonstr is None:
+        jsonstr = _json_encode_stdlib(result)
+    metrics.observe('serialize', time.perf_counter() - start)
+    return jsonstr
+
+def round_levels(result, digits):
+    """
+    Round the activity levels in *result* to *digits* significant digits
+    in place, returning *result*.  This includes the totals, the decay
+    curve and the sweep grid.  If *digits* is None the levels are left at full precision.
+    """
+    if digits is None:
+        return result
+    fmt = '%.' + str(digits) + 'g'
+    def rounded(values):
+        return [rounded(v) if isinstance(v, list) else float(fmt % v)
+                for v in values]
+    for name in ('activation', 'sweep'):
+        section = result.get(name)
+        if not isinstance(section, dict) or 'error' in section:
+            continue
+        for row in section.get('activity', []):
+            row['levels'] = rounded(row['levels'])
+        if 'total' in section:
+            section['total'] = rounded(section['total'])
+        curve = section.get('curve')
+        if curve is not None:
+            curve['total'] = rounded(curve['total'])
+            curve['levels'] = rounded(curve['levels'])
+    return result
+
 def json_response(result):
-    jsonstr = json.dumps(result)
-    # Cross-site scripting (XSS) defense. There is no reason for the returned
-    # JSON strings to include an unescaped "<" character, so if one slips
-    # through from malicious inputs or from code in an error traceback it will
-    # be sanitized here. Note that this is not true in general; if your web
-    # service returns html strings instead of adding markup in the browser,
-    # then you will need to sanitize the inputs instead of the outputs.
-    jsonstr = escape(jsonstr, quote=False)
+    jsonstr = json_encode(result)
     #print(jsonstr, file=sys.stderr)
     print("Content-Type: application/json; charset=UTF-8")
     print("Access-Control-Allow-Origin: *")
     print("Content-Length: %d\n"%(len(jsonstr)+1))
     print(jsonstr)
+    # Send the response now rather than at exit, which may be held up by
+    # a timed out section.
+    sys.stdout.flush()
 respond = json_response
 
+def wants_stream(form):
+    """True if the request asks for a newline-delimited JSON response."""
+    return form.getfirst('format', 'json') == 'ndjson'
+
+def stream_request(form):
+    """
+    Generator for the response to *form* as newline-delimited JSON.
+
+    Each line is a separate JSON record, encoded and escaped on its own so
+    that it can be sent as soon as it is ready.  Every record has a *record*
+    field giving its type:
+
+    * *batch* is the header for a batch request, and is followed by one
+      *sample* record for each sample, with *index* giving its position
+      in the batch.
+    * *result* is the response for a single sample with the activity table
+      removed.  It is followed by one *activity* record for each activation
+      product, with *index* giving the row number.  If a decay curve was
+      requested, the levels for the product are in the *curve* field of
+      the row rather than in the result.  The rows of a sweep are sent
+      the same way.
+    * *error* reports an unexpected exception part way through the stream.
+
+    Batch requests do not go through handle_request, so they are counted
+    and timed in *metrics* here once the stream is complete.
+    """
+    start = time.perf_counter()
+    batch = form.getfirst('samples') is not None
+    status = None
+    try:
+        if batch:
+            records = _iter_batch_records(iter_batch(form))
+        else:
+            records = _iter_result_records(handle_request(form))
+        for record in records:
+            if record['record'] == 'batch':
+                status = 'success' if record['success'] else 'invalid'
+            yield json_encode(record) + "\n"
+    except Exception:
+        if batch:
+            status = 'error'
+        yield json_encode({
+            'record': 'error',
+            'success': False,
+            'version': periodictable.__version__,
+            'detail': {'query': error()},
+            'error': 'unexpected exception',
+        }) + "\n"
+    if status is not None:
+        metrics.count_request(status)
+        metrics.observe('request', time.perf_counter() - start)
+
+def _record(kind, fields, **extra):
+    record = {'record': kind}
+    record.update(extra)
+    record.update(fields)
+    return record
+
+def _iter_batch_records(batch):
+    yield _record('batch', next(batch))
+    for index, sample_result in enumerate(batch):
+        yield _record('sample', sample_result, index=index)
+
+def _iter_result_records(result):
+    section = result.get('activation', result.get('sweep', {}))
+    rows = section.pop('activity', [])
+    curve = section.get('curve', {}).pop('levels', None)
+    yield _record('result', result)
+    for index, row in enumerate(rows):
+        if curve is not None:
+            row['curve'] = curve[index]
+        yield _record('activity', row, index=index)
+
+def ndjson_response(lines):
+    """
+    Print the lines from :func:`stream_request` as a cgi response, flushing
+    after each line.  The length is not known in advance so there is no
+    Content-Length header.
+    """
+    print("Content-Type: application/x-ndjson; charset=UTF-8")
+    print("Access-Control-Allow-Origin: *\n")
+    sys.stdout.flush()
+    for line in lines:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
 def error():
     if DEBUG:
         return traceback.format_exc()
@@ -181,9 +461,14 @@ HOUR_SCALE = {
     'y': 365.2425*24,
 }
 
+def is_date(s):
+    """True if the rest time *s* is a beam off date rather than a duration."""
+    return '-' in s or ':' in s
+
 def parse_rest(s):
-    if '-' in s or ':' in s:
+    if is_date(s):
         timestamp = parse_date(s.strip())
+        utc = load_module('parse', 'pytz').utc
         delta = utc.localize(datetime.utcnow()) - timestamp
         hours = (delta.days*24*3600 + delta.seconds)/3600.0
         if hours < 0:
@@ -203,14 +488,75 @@ def parse_hours(s):
     except:
         raise ValueError("expected time as value and units (h,m,s,d,w,y) or beam off date/time")
 
-def parse_date(datestring, default_timezone=default_timezone):
+def parse_axis(text, parse):
+    """
+    Parse the values for one axis of a sweep.
+
+    *text* is a single value, a comma separated list of values, or a range
+    "start:stop:count" with *count* evenly spaced values from *start* to
+    *stop*.  Add ":log" to the range for logarithmic spacing.  Each value
+    is converted with *parse*.
+
+    Returns a list of values.
+    """
+    text = str(text).strip()
+    if ':' not in text:
+        return [parse(v) for v in text.split(',')]
+    parts = [v.strip() for v in text.split(':')]
+    scale = 'linear'
+    if len(parts) == 4 and parts[3] in ('linear', 'log'):
+        scale = parts.pop()
+    if len(parts) != 3:
+        raise ValueError("range should be start:stop:count or start:stop:count:log")
+    start, stop, count = parse(parts[0]), parse(parts[1]), int(parts[2])
+    if count < 1:
+        raise ValueError("range count should be positive")
+    if scale == 'log':
+        if start <= 0 or stop <= 0:
+            raise ValueError("range should be positive for log spacing")
+        return np.geomspace(start, stop, count).tolist()
+    return np.linspace(start, stop, count).tolist()
+
+def parse_curve(form, rest_times):
+    """
+    Parse the decay curve time grid from the form.
+
+    *curve* is the number of points on the grid, or 0 for no decay curve.
+    *curve_scale* is 'log' (the default) or 'linear'.  *curve_start* and
+    *curve_stop* give the range of the grid as times after the end of the
+    exposure, with the start defaulting to 1 minute for a log grid or 0 for
+    a linear grid, and the stop defaulting to the largest rest time.
+
+    Returns an array of times in hours, or None if no curve is requested.
+    """
+    points = int(form.getfirst('curve', '0'))
+    if points <= 0:
+        return None
+    if points > MAX_CURVE_POINTS:
+        raise ValueError("curve is limited to %d points"%MAX_CURVE_POINTS)
+    scale = form.getfirst('curve_scale', 'log')
+    if scale not in ('log', 'linear'):
+        raise ValueError("curve_scale should be 'log' or 'linear'")
+    default_start = '1m' if scale == 'log' else '0'
+    start = parse_hours(form.getfirst('curve_start', default_start))
+    stop = form.getfirst('curve_stop')
+    stop = parse_hours(stop) if stop is not None else max(rest_times)
+    if stop <= start:
+        raise ValueError("curve_stop should be after curve_start")
+    if scale == 'log':
+        if start <= 0:
+            raise ValueError("curve_start should be positive for a log scale curve")
+        return np.geomspace(start, stop, points)
+    return np.linspace(start, stop, points)
+
+def parse_date(datestring, default_timezone=None):
     """
     Parses ISO 8601 dates into datetime objects
 
     The timezone is parsed from the date string. However it is quite common to
     have dates without a timezone (not strictly correct). In this case the
-    default timezone specified in default_timezone is used. This is UTC by
-    default.
+    default timezone specified in default_timezone is used. This is the
+    timezone named by DEFAULT_TIMEZONE by default.
 
     Missing parts are assigned the latest value rather than the earliest value.
     For example, 2010-03 is returned as 2010-03-31 23:59:59.  This is done
@@ -241,6 +587,10 @@ def parse_date(datestring, default_timezone=default_timezone):
     second = int(groups["second"]) if groups["second"] else 59
     fraction = int(float("0.%s" % groups["fraction"]) * 1e6) if groups["fraction"] else 0
     dt = datetime(year, month, day, hour, minute, second, fraction)
+    pytz = load_module('parse', 'pytz')
+    utc = pytz.utc
+    if default_timezone is None:
+        default_timezone = pytz.timezone(DEFAULT_TIMEZONE)
     if groups["timezone"] is None:
         dt = default_timezone.normalize(default_timezone.localize(dt))
     elif groups["timezone"] == "Z":
@@ -253,85 +603,139 @@ def parse_date(datestring, default_timezone=default_timezone):
         dt = utc.localize(dt) - timedelta(0, offset)
     return dt
 
-def cgi_call(form):
-    #print(form, file=sys.stderr)
-    #print >>sys.stderr, "sample",form.getfirst('sample')
-    #print >>sys.stderr, "mass",form.getfirst('mass')
+def parse_mass(mass_str):
+    if mass_str.endswith('kg'):
+        return 1000*float(mass_str[:-2])
+    elif mass_str.endswith('mg'):
+        return 0.001*float(mass_str[:-2])
+    elif mass_str.endswith('ug'):
+        return 1e-6*float(mass_str[:-2])
+    elif mass_str.endswith('g'):
+        return float(mass_str[:-1])
+    else:
+        return float(mass_str)
 
-    # Parse inputs
-    errors = {}
-    calculate = form.getfirst('calculate', 'all')
-    if calculate not in ('scattering', 'activation', 'all'):
+def parse_conditions(form, errors):
+    """
+    Parse the exposure and measurement conditions from the form.
+
+    These are the inputs which are shared by all samples in a batch request.
+    Returns a dictionary of parsed values.  Parse errors are recorded
+    in *errors*.
+    """
+    cond = {'timer': StageTimer()}
+    cond['calculate'] = form.getfirst('calculate', 'all')
+    if cond['calculate'] not in ('scattering', 'activation', 'all'):
         errors['calculate'] = "calculate should be one of 'scattering', 'activation' or 'all'"
-    try:
-        sample = form.getfirst('sample')
-        chem = formula(sample)
-    except Exception:
-        errors['sample'] = error()
-    try:
-        fluence = float(form.getfirst('flux', 100000))
-    except Exception:
-        errors['flux'] = error()
-    try:
-        fast_ratio = float(form.getfirst('fast', '0'))
-    except Exception:
-        errors['fast'] = error()
-    try:
-        Cd_ratio = float(form.getfirst('Cd', '0'))
-    except Exception:
-        errors['Cd'] = error()
-    try:
-        exposure = parse_hours(form.getfirst('exposure', '1'))
-    except Exception:
-        errors['exposure'] = error()
-    try:
-        mass_str = form.getfirst('mass', '0')
-        if mass_str.endswith('kg'):
-            mass = 1000*float(mass_str[:-2])
-        elif mass_str.endswith('mg'):
-            mass = 0.001*float(mass_str[:-2])
-        elif mass_str.endswith('ug'):
-            mass = 1e-6*float(mass_str[:-2])
-        elif mass_str.endswith('g'):
-            mass = float(mass_str[:-1])
-        else:
-            mass = float(mass_str)
-    except Exception:
-        errors['mass'] = error()
-    try:
-        density_type, density_value = parse_density(form.getfirst('density', '0'))
-    except Exception:
-        errors['density'] = error()
+    # Each of flux, exposure, fast and Cd may be a list or range of values,
+    # in which case the activation is computed over the grid of all
+    # combinations.  The scalar conditions hold the first value of each.
+    sweep = OrderedDict()
+    for field, key, default, parse in SWEEP_AXES:
+        try:
+            values = parse_axis(form.getfirst(field, default), parse or parse_hours)
+            cond[key] = values[0]
+            sweep[field] = values
+        except Exception:
+            errors[field] = error()
+    cond['sweep'] = None
+    if len(sweep) == len(SWEEP_AXES) and any(len(v) > 1 for v in sweep.values()):
+        points = 1
+        for values in sweep.values():
+            points *= len(values)
+        if points > MAX_SWEEP_POINTS:
+            errors['sweep'] = "sweep is limited to %d combinations"%MAX_SWEEP_POINTS
+        cond['sweep'] = sweep
     try:
         #print >>sys.stderr,form.getlist('rest[]')
-        rest_times = [parse_rest(v) for v in form.getlist('rest[]')]
+        rest = form.getlist('rest[]')
+        rest_times = [parse_rest(v) for v in rest]
         if not rest_times:
             rest_times = [0, 1, 24, 360]
+        cond['rest_times'] = rest_times
+        # Beam off dates are relative to the current time so the results
+        # for the request cannot be reused.
+        cond['cacheable'] = not any(is_date(v) for v in rest)
     except Exception:
         errors['rest'] = error()
     try:
-        decay_level = float(form.getfirst('decay', '0.001'))
+        # One or more comma separated target activity levels.
+        levels = [float(v) for v in form.getfirst('decay', '0.001').split(',')]
+        if any(v <= 0 for v in levels):
+            raise ValueError("decay level should be positive")
+        cond['decay_levels'] = levels
+        cond['decay_level'] = levels[0]
     except Exception:
         errors['decay'] = error()
     try:
-        thickness = float(form.getfirst('thickness', '1'))
+        # Significant digits for the activity levels in the response.
+        digits = form.getfirst('digits')
+        if digits is not None:
+            digits = int(digits)
+            if not 1 <= digits <= 17:
+                raise ValueError("digits should be between 1 and 17")
+        cond['digits'] = digits
     except Exception:
-        errors['thickness'] = error()
+        errors['digits'] = error()
+    # Debugging information to add to the response, such as solver timing.
+    cond['debug'] = set(v.strip() for v in form.getfirst('debug', '').split(',') if v.strip())
+    if cond['debug']:
+        cond['cacheable'] = False
+    try:
+        cond['curve'] = parse_curve(form, cond.get('rest_times', [0]))
+    except Exception:
+        errors['curve'] = error()
+    # The sweep section has no decay curve or solver comparison.
+    if cond['sweep'] is not None and cond['calculate'] in ('activation', 'all'):
+        if cond.get('curve') is not None:
+            errors['curve'] = "curve is not available for a sweep"
+        if 'decay' in cond['debug']:
+            errors['debug'] = "debug=decay is not available for a sweep"
+    if cond['calculate'] in ('scattering', 'all'):
+        parse_scattering_conditions(form, cond, errors)
+    try:
+        # Abundance functions are named here and looked up in
+        # periodictable.activation when the activation section runs.
+        abundance_source = form.getfirst('abundance', 'IAEA')
+        if abundance_source == "IUPAC":
+            abundance = 'table_abundance'
+        # CRUFT: periodictable no longer uses NIST 2001 data for abundance
+        elif abundance_source == "NIST":
+            abundance = 'table_abundance'
+        elif abundance_source == "IAEA":
+            abundance = 'IAEA1987_isotopic_abundance'
+        else:
+            raise ValueError("abundance should be IUPAC or IAEA")
+        cond['abundance'] = abundance
+    except Exception:
+        errors['abundance'] = error()
+    return cond
+
+def parse_scattering_conditions(form, cond, errors):
+    """
+    Parse the neutron and xray wavelengths into *cond*.  These are only
+    needed, and the scattering tables only loaded, if the scattering
+    sections are calculated.
+    """
     try:
         wavelength_str = form.getfirst('wavelength', '1').strip()
         if wavelength_str.endswith('meV'):
+            nsf = load_module('scattering', 'periodictable.nsf')
             wavelength = nsf.neutron_wavelength(float(wavelength_str[:-3]))
         elif wavelength_str.endswith('m/s'):
+            nsf = load_module('scattering', 'periodictable.nsf')
             wavelength = nsf.neutron_wavelength_from_velocity(float(wavelength_str[:-3]))
         elif wavelength_str.endswith('Ang'):
             wavelength = float(wavelength_str[:-3])
         else:
             wavelength = float(wavelength_str)
+        cond['wavelength'] = wavelength
         #print >>sys.stderr,wavelength_str
     except Exception:
         errors['wavelength'] = error()
     try:
         xray_source = form.getfirst('xray', 'Cu Ka').strip()
+        xsf = load_module('xray_scattering', 'periodictable.xsf')
         if xray_source.endswith('Ka'):
             xray_wavelength = elements.symbol(xray_source[:-2].strip()).K_alpha
         elif xray_source.endswith('keV'):
@@ -342,26 +746,775 @@ def cgi_call(form):
             xray_wavelength = elements.symbol(xray_source).K_alpha
         else:
             xray_wavelength = float(xray_source)
+        cond['xray_wavelength'] = xray_wavelength
         #print >>sys.stderr,"xray",xray_source,xray_wavelength
     except Exception:
         errors['xray'] = error()
+
+def parse_sample(form, errors, timer=None):
+    """
+    Parse the sample description (formula, mass, density and thickness).
+
+    Returns a dictionary of parsed values.  Parse errors are recorded
+    in *errors*.  The time to parse the formula is added to the *formula*
+    stage of *timer*, if given; the caller records the *parse* stage.
+    """
+    timer = timer if timer is not None else StageTimer()
+    spec = {}
     try:
-        abundance_source = form.getfirst('abundance', 'IAEA')
-        if abundance_source == "IUPAC":
-            abundance = activation.table_abundance
-        # CRUFT: periodictable no longer uses NIST 2001 data for abundance
-        elif abundance_source == "NIST":
-            abundance = activation.table_abundance
-        elif abundance_source == "IAEA":
-            abundance = activation.IAEA1987_isotopic_abundance
-        else:
-            raise ValueError("abundance should be IUPAC or IAEA")
+        spec['sample'] = form.getfirst('sample')
+        with timer.stage('formula'):
+            spec['chem'], spec['derived'] = parse_formula(spec['sample'])
     except Exception:
-        errors['abundance'] = error()
+        errors['sample'] = error()
+    try:
+        spec['mass'] = parse_mass(form.getfirst('mass', '0'))
+    except Exception:
+        errors['mass'] = error()
+    try:
+        spec['density'] = parse_density(form.getfirst('density', '0'))
+    except Exception:
+        errors['density'] = error()
+    try:
+        spec['thickness'] = float(form.getfirst('thickness', '1'))
+    except Exception:
+        errors['thickness'] = error()
+    return spec
 
+def add_parse_time(timer, start):
+    """
+    Record the time since *start* as the *parse* stage of *timer*, less
+    the time in the *formula* stage, which is recorded separately.
+    """
+    formula = timer.report().get('formula', 0.)
+    timer.add('parse', time.perf_counter() - start - formula)
+
+def cgi_call(form):
+    #print(form, file=sys.stderr)
+    #print >>sys.stderr, "sample",form.getfirst('sample')
+    #print >>sys.stderr, "mass",form.getfirst('mass')
+
+    if form.getfirst('samples') is not None:
+        return batch_call(form)
+
+    # Parse inputs
+    errors = {}
+    start = time.perf_counter()
+    cond = parse_conditions(form, errors)
+    spec = parse_sample(form, errors, cond['timer'])
+    add_parse_time(cond['timer'], start)
     if errors:
         return {'success':False, 'error':'invalid request', 'detail':errors}
 
+    result = {
+        'success': True,
+        'version': periodictable.__version__,
+        }
+    result.update(cached_calculate_sample(spec, cond))
+    if 'imports' in cond['debug']:
+        result['imports'] = load_report()
+    if 'timing' in cond['debug']:
+        result['timing'] = cond['timer'].report()
+    return result
+
+def batch_call(form):
+    """
+    Run the calculation for a list of samples under the same conditions.
+
+    The *samples* field is a JSON list of records, each with *sample* and
+    optionally *mass*, *density* and *thickness* fields using the same
+    syntax as the single sample request.  A record may also be a bare
+    formula string.  The remaining fields (flux, exposure, rest times, etc.)
+    are parsed once and shared by all samples.
+
+    Errors in an individual record are reported in the result for that
+    record without affecting the rest of the batch.
+    """
+    batch = iter_batch(form)
+    result = next(batch)
+    if result['success']:
+        result['samples'] = list(batch)
+    return result
+
+def iter_batch(form):
+    """
+    Generator for the batch request in *form*.
+
+    The first item is the response header, which is an error response if
+    the request could not be parsed.  This is followed by the result for
+    each sample, computed as it is requested.
+    """
+    errors = {}
+    start = time.perf_counter()
+    cond = parse_conditions(form, errors)
+    try:
+        records = json.loads(form.getfirst('samples'))
+        if not isinstance(records, list):
+            raise ValueError("samples should be a list of sample records")
+        if len(records) > MAX_SAMPLES:
+            raise ValueError("limited to %d samples"%MAX_SAMPLES)
+    except Exception:
+        errors['samples'] = error()
+    add_parse_time(cond['timer'], start)
+    if errors:
+        yield {'success':False, 'error':'invalid request', 'detail':errors}
+        return
+
+    header = {
+        'success': True,
+        'version': periodictable.__version__,
+    }
+    if 'imports' in cond['debug']:
+        # Reported before the samples are calculated, so this only shows
+        # what was loaded in parsing the request.
+        header['imports'] = load_report()
+    if 'timing' in cond['debug']:
+        # Time to parse the shared conditions; each sample has its own.
+        header['timing'] = cond['timer'].report()
+    yield header
+
+    # Fields missing from a record default to the values in the form.
+    defaults = dict((k, form.getfirst(k)) for k in ('mass', 'density', 'thickness')
+                    if form.getfirst(k) is not None)
+    for record in records:
+        if not isinstance(record, dict):
+            record = {'sample': record}
+        record = dict((k, v if isinstance(v, str) else str(v)) for k, v in record.items())
+        record_errors = {}
+        sample_cond = dict(cond, timer=StageTimer())
+        start = time.perf_counter()
+        spec = parse_sample(FakeFieldStorage(defaults, **record), record_errors,
+                            sample_cond['timer'])
+        add_parse_time(sample_cond['timer'], start)
+        if record_errors:
+            yield {'success':False, 'error':'invalid request', 'detail':record_errors}
+            continue
+        try:
+            sample_result = {'success': True}
+            sample_result.update(cached_calculate_sample(spec, sample_cond))
+        except Exception:
+            sample_result = {'success': False, 'error': 'unexpected exception',
+                             'detail': {'query': error()}}
+        if 'timing' in cond['debug']:
+            sample_result['timing'] = sample_cond['timer'].report()
+        yield sample_result
+
+class LRUCache(object):
+    """
+    Bounded mapping which discards the least recently used entry when full.
+
+    Hit and miss counts are kept so that the effectiveness of the cache
+    can be monitored.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+formula_cache = LRUCache(FORMULA_CACHE_SIZE)
+
+class StageTimer(object):
+    """
+    Time spent in each stage of a request.
+
+    The stages are input parsing (*parse*), formula construction
+    (*formula*), result cache lookup (*cache*), the activation table
+    (*activation*), the decay time solver (*decay_time*), the decay curve
+    (*decay_curve*), neutron scattering (*scattering*) and xray scattering
+    (*xray*).  Times for a stage which runs more than once are summed.
+    Each time is also recorded in the process-wide *metrics*.
+    """
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.) + seconds
+        metrics.observe(name, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self):
+        with self._lock:
+            return dict(self.seconds)
+
+class Metrics(object):
+    """
+    Request counts and stage time histograms for this process, in the
+    Prometheus text exposition format.
+    """
+    # Histogram bucket upper bounds in seconds.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.requests = OrderedDict()
+            self.stages = OrderedDict()  # {name: [bucket counts..., sum, count]}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = [0]*len(self.BUCKETS) + [0., 0]
+            for k, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[k] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def count_request(self, status):
+        with self._lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+
+    def prometheus(self):
+        """Return the metrics as Prometheus text."""
+        with self._lock:
+            requests = list(self.requests.items())
+            stages = [(name, list(hist)) for name, hist in self.stages.items()]
+        lines = [
+            "# HELP nact_requests_total Calculator requests by result.",
+            "# TYPE nact_requests_total counter",
+        ]
+        lines.extend('nact_requests_total{status="%s"} %d' % item for item in requests)
+        lines.extend([
+            "# HELP nact_stage_seconds Time spent in each stage of a request.",
+            "# TYPE nact_stage_seconds histogram",
+        ])
+        for name, hist in stages:
+            for bound, count in zip(self.BUCKETS, hist):
+                lines.append('nact_stage_seconds_bucket{stage="%s",le="%g"} %d'
+                             % (name, bound, count))
+            lines.append('nact_stage_seconds_bucket{stage="%s",le="+Inf"} %d'
+                         % (name, hist[-1]))
+            lines.append('nact_stage_seconds_sum{stage="%s"} %.9g' % (name, hist[-2]))
+            lines.append('nact_stage_seconds_count{stage="%s"} %d' % (name, hist[-1]))
+        caches = (('result', result_cache), ('formula', formula_cache))
+        for metric, key, kind, help_text in (
+                ('nact_cache_hits_total', 'hits', 'counter', 'Cache hits.'),
+                ('nact_cache_misses_total', 'misses', 'counter', 'Cache misses.'),
+                ('nact_cache_entries', 'size', 'gauge', 'Entries in the cache.')):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for name, cache in caches:
+                lines.append('%s{cache="%s"} %d' % (metric, name, cache.stats()[key]))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def parse_formula(sample):
+    """
+    Parse the *sample* formula, returning (chem, derived).
+
+    *chem* is a new copy of the parsed formula which the caller is free
+    to modify, for example by setting its density.  *derived* holds values
+    computed from the formula as parsed: *formula* (canonical string),
+    *latex*, *molecular_mass*, *mass_fraction*, *density* and
+    *natural_density*.  It is shared between requests so treat it as
+    read-only.
+
+    Parsed formulas are kept in *formula_cache*, keyed by the sample string.
+    """
+    entry = formula_cache.get(sample)
+    if entry is None:
+        formulas = load_module('parse', 'periodictable.formulas')
+        chem = formulas.formula(sample)
+        derived = {
+            'formula': str(chem),
+            'latex': formulas.pretty(chem, 'latex'),
+            'molecular_mass': chem.molecular_mass,
+            'mass_fraction': chem.mass_fraction,
+            'density': chem.density,
+            'natural_density': chem.natural_density,
+        }
+        entry = chem, derived
+        formula_cache.put(sample, entry)
+    chem, derived = entry
+    return copy(chem), derived
+
+def request_key(spec, cond):
+    """
+    Normalized form of the request for *spec* under *cond*, or None if the
+    request cannot be cached.
+
+    The key uses the canonical formula string along with the formula
+    attributes that affect the default density and mass, so that equivalent
+    spellings of the same sample share a cache entry.
+    """
+    if not cond.get('cacheable', False):
+        return None
+    chem = spec['chem']
+    sample_key = (
+        spec['derived']['formula'], chem.density,
+        getattr(chem, 'total_mass', None),
+        getattr(chem, 'total_volume', None),
+        getattr(chem, 'thickness', None),
+        )
+    return (
+        sample_key, spec['mass'], spec['density'], spec['thickness'],
+        cond['calculate'], cond['fluence'], cond['fast_ratio'],
+        cond['Cd_ratio'], cond['exposure'], tuple(cond['rest_times']),
+        tuple(cond['decay_levels']), cond.get('wavelength'),
+        cond.get('xray_wavelength'), cond['abundance'],
+        None if cond['curve'] is None else tuple(cond['curve']),
+        None if cond['sweep'] is None else tuple(tuple(v) for v in cond['sweep'].values()),
+        )
+
+def cached_calculate_sample(spec, cond):
+    """
+    Return calculate_sample(spec, cond), reusing the result of an equivalent
+    earlier request if it is available in *result_cache*.
+
+    The cache holds full precision results, with the levels rounded to
+    *cond['digits']* on the way out.
+    """
+    key = request_key(spec, cond)
+    if key is None:
+        return round_levels(calculate_sample(spec, cond), cond['digits'])
+    timer = cond['timer']
+    with timer.stage('cache'):
+        result = result_cache.get(key)
+    if result is None:
+        result = calculate_sample(spec, cond)
+        # Don't save incomplete results.
+        if not any(isinstance(v, dict) and v.get('timeout') for v in result.values()):
+            with timer.stage('cache'):
+                result_cache.put(key, deepcopy(result))
+    else:
+        with timer.stage('cache'):
+            result = deepcopy(result)
+        # Report the sample as the user wrote it.
+        result['sample']['name'] = spec['sample']
+    return round_levels(result, cond['digits'])
+
+def decay_curve(activity, rest_times, times):
+    """
+    Activity for each product and in total at each of the given *times*.
+
+    *activity* is the table of activity levels at *rest_times* for each
+    activation product.  The activity is propagated from the earliest rest
+    time to the curve times using the product decay constants, computed as
+    a single outer product of activities and decay factors.
+
+    Returns columns *time*, *total* and *levels*, with one row of levels for
+    each product in the same order as the activation table.
+    """
+    k = min(range(len(rest_times)), key=lambda i: rest_times[i])
+    A = np.array([levels[k] for levels in activity.values()], dtype='d')
+    lam = np.array([LN2/el.Thalf_hrs for el in activity], dtype='d')
+    with np.errstate(over='ignore', under='ignore'):
+        levels = A[:, None]*np.exp(-np.outer(lam, times - rest_times[k]))
+    return {
+        'time': times.tolist(),
+        'total': levels.sum(axis=0).tolist(),
+        'levels': levels.tolist(),
+    }
+
+# Conversion from Bq to uCi used by periodictable.activation.activity
+BQ_TO_UCI = 1.6276e19
+
+_math_exp = np.vectorize(exp, otypes='d')
+
+class ActivationTable(object):
+    """
+    Array form of the periodictable activation data.
+
+    There is one row for each (target isotope, reaction) pair, holding the
+    cross sections, half-lives and reaction type needed to compute the
+    activity, with the row ranges for each target isotope recorded in
+    *rows*.  The activation of a sample is then a sparse product of the
+    mass of each target isotope in the sample with the table, evaluated
+    for all rows at once.
+
+    The results match periodictable.activation.Sample.calculate_activation,
+    including the order of the products, and use the same ActivationResult
+    objects as keys.
+    """
+    def __init__(self):
+        results, target_A = [], []
+        self.rows = {}  # {(Z, A): (start, stop)}
+        for el in elements:
+            for iso_num in el.isotopes:
+                iso = el[iso_num]
+                reactions = getattr(iso, 'neutron_activation', ())
+                if reactions:
+                    self.rows[iso.number, iso.isotope] = (
+                        len(results), len(results) + len(reactions))
+                    results.extend(reactions)
+                    target_A.extend([iso.isotope]*len(reactions))
+        self.results = results
+        column = lambda f: np.array([f(ai) for ai in results], dtype='d')
+        self.A = np.array(target_A, dtype='d')
+        self.thermalXS = column(lambda ai: ai.thermalXS)
+        self.resonance = column(lambda ai: ai.resonance)
+        self.thermalXS_parent = column(lambda ai: ai.thermalXS_parent)
+        self.resonance_parent = column(lambda ai: ai.resonance_parent)
+        self.lam = LN2/column(lambda ai: ai.Thalf_hrs)
+        self.parent_lam = LN2/column(lambda ai: ai.Thalf_parent or np.inf)
+        self.fast = np.array([ai.fast for ai in results], dtype=bool)
+        self.beta = np.array([ai.reaction == 'b' for ai in results], dtype=bool)
+        self.double = np.array([ai.reaction == '2n' for ai in results], dtype=bool)
+        self._weights = {}
+
+    def weights(self, abundance):
+        """
+        Return {(Z, A): fraction} for the isotopes of each element under the
+        *abundance* function, keeping only those with activation data.
+        """
+        if abundance not in self._weights:
+            weights = {}
+            for el in elements:
+                weights[el.number] = [
+                    ((el.number, iso_num), abundance(el[iso_num])*0.01)
+                    for iso_num in el.isotopes]
+            self._weights[abundance] = weights
+        return self._weights[abundance]
+
+    def target_mass(self, mass_fraction, mass, abundance):
+        """
+        Mass (g) of each target isotope in the sample, keyed by (Z, A)
+        and in the order that Sample.calculate_activation visits them.
+        """
+        weights = self.weights(abundance)
+        targets = OrderedDict()
+        for el, frac in mass_fraction.items():
+            if isisotope(el):
+                parts = [((el.number, el.isotope), 1.)]
+            else:
+                parts = weights[el.number]
+            for key, weight in parts:
+                iso_mass = mass*frac*weight
+                if iso_mass and key in self.rows:
+                    targets[key] = targets.get(key, 0.) + iso_mass
+        return targets
+
+    def activity(self, chem, mass, env, exposure=1, rest_times=(0, 1, 24, 360),
+                 abundance=None, mass_fraction=None):
+        """
+        Activity (uCi) of each product at each of the *rest_times*.
+
+        *abundance* defaults to activation.table_abundance.  *mass_fraction*
+        is chem.mass_fraction, if it is already available.
+
+        Returns {ActivationResult: [activity at each rest time]}, as would be
+        found in activation.Sample.activity after calculate_activation.
+        """
+        index, row_mass = self.sample_rows(
+            chem, mass, abundance, mass_fraction, fast=env.fast_ratio != 0)
+        A0 = self.end_of_exposure(
+            index, row_mass, env.fluence, env.fast_ratio, env.Cd_ratio, exposure)
+        levels = A0[:, None]*np.exp(-np.outer(self.lam[index], rest_times))
+        return OrderedDict(
+            (self.results[k], v) for k, v in zip(index, levels.tolist()))
+
+    def sweep(self, chem, mass, fluence, exposure, fast_ratio, Cd_ratio,
+              rest_times=(0, 1, 24, 360), abundance=None, mass_fraction=None):
+        """
+        Activity (uCi) of each product over a grid of exposure conditions.
+
+        *fluence*, *exposure*, *fast_ratio* and *Cd_ratio* are lists of
+        values for the axes of the grid.  The activity is not linear in
+        fluence once burnup matters, so rather than scaling a single
+        calculation, :meth:`end_of_exposure` is evaluated once with each
+        axis broadcast against the others.
+
+        Returns (products, levels), where *products* is the list of
+        ActivationResult for the rows of *levels*, and *levels* has shape
+        (product, fluence, exposure, fast_ratio, Cd_ratio, rest time).
+        """
+        fluence, exposure, fast_ratio, Cd_ratio = (
+            np.asarray(v, dtype='d') for v in (fluence, exposure, fast_ratio, Cd_ratio))
+        index, row_mass = self.sample_rows(
+            chem, mass, abundance, mass_fraction, fast=(fast_ratio != 0).any())
+        # Put each axis in its own dimension, with the rows last.
+        axis = lambda v, k: v.reshape([-1 if j == k else 1 for j in range(4)] + [1])
+        A0 = self.end_of_exposure(
+            index, row_mass, axis(fluence, 0), axis(fast_ratio, 2),
+            axis(Cd_ratio, 3), axis(exposure, 1))
+        decay = np.exp(-np.outer(self.lam[index], rest_times))
+        levels = np.moveaxis(A0, -1, 0)[..., None]*decay[:, None, None, None, None, :]
+        return [self.results[k] for k in index], levels
+
+    def sample_rows(self, chem, mass, abundance=None, mass_fraction=None, fast=True):
+        """
+        Table rows for the target isotopes in *chem* and the target mass
+        for each row.  Fast neutron reactions are left out if *fast* is False.
+
+        *abundance* defaults to activation.table_abundance.  *mass_fraction*
+        is chem.mass_fraction, if it is already available.
+        """
+        if abundance is None:
+            abundance = load_module('activation', 'periodictable.activation').table_abundance
+        if mass_fraction is None:
+            mass_fraction = chem.mass_fraction
+        index, row_mass = [], []
+        for key, iso_mass in self.target_mass(mass_fraction, mass, abundance).items():
+            start, stop = self.rows[key]
+            index.extend(range(start, stop))
+            row_mass.extend([iso_mass]*(stop - start))
+        index, row_mass = np.array(index, dtype=int), np.array(row_mass, dtype='d')
+        # Ignore fast neutron interactions if not using fast ratio
+        if not fast:
+            keep = ~self.fast[index]
+            index, row_mass = index[keep], row_mass[keep]
+        return index, row_mass
+
+    def end_of_exposure(self, index, row_mass, fluence, fast_ratio, Cd_ratio, exposure):
+        """
+        Activity at the end of the exposure for the table rows in *index*
+        with target masses *row_mass*.
+
+        The environment values *fluence*, *fast_ratio*, *Cd_ratio* and
+        *exposure* may be arrays, in which case they broadcast against the
+        rows in the last dimension.
+
+        This follows periodictable.activation.activity, which documents the
+        correspondence with the columns of the NCNR activation spreadsheet.
+        """
+        thermalXS, resonance = self.thermalXS[index], self.resonance[index]
+        thermalXS_parent = self.thermalXS_parent[index]
+        resonance_parent = self.resonance_parent[index]
+        lam, parent_lam = self.lam[index], self.parent_lam[index]
+        fast, beta, double = self.fast[index], self.beta[index], self.double[index]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            Cd_ratio = np.asarray(Cd_ratio, dtype='d')
+            epithermal_reduction_factor = np.where(Cd_ratio >= 1, 1./Cd_ratio, 0.)
+            initialXS = thermalXS + epithermal_reduction_factor*resonance
+            effectiveXS = thermalXS_parent + epithermal_reduction_factor*resonance_parent
+            flux = np.where(fast, fluence/np.asarray(fast_ratio, dtype='d'), fluence)
+            root = flux * (initialXS * 1e-24) * row_mass / self.A[index] * BQ_TO_UCI
+
+            # "b" mode production
+            b_activity = root/(parent_lam - lam) * (
+                lam*np.expm1(-parent_lam*exposure) - parent_lam*np.expm1(-lam*exposure))
+
+            # "2n" mode production
+            # The three terms nearly cancel for short exposures, so use the
+            # same exp() as periodictable to reproduce its values exactly.
+            # Only the "2n" entries are evaluated since this is not vectorized.
+            def exp_2n(x):
+                x, mask = np.broadcast_arrays(x, double)
+                result = np.zeros(x.shape)
+                if mask.any():
+                    result[mask] = _math_exp(x[mask])
+                return result
+            lam_2n = (flux*3600)*(initialXS*1e-24)
+            parent_activity = (fluence*3600)*(effectiveXS*1e-24) + parent_lam
+            product_2n = lam
+            n2_activity = root*lam*(parent_activity-parent_lam)*(
+                (exp_2n(-lam_2n*exposure)
+                 / ((parent_activity-lam_2n)*(product_2n-lam_2n)))
+                + (exp_2n(-parent_activity*exposure)
+                   / ((lam_2n-parent_activity)*(product_2n-parent_activity)))
+                + (exp_2n(-product_2n*exposure)
+                   / ((lam_2n-product_2n)*(parent_activity-product_2n)))
+                )
+
+            # single capture with burnup
+            U = (flux*3600)*(initialXS*1e-24)*exposure
+            V = ((fluence*3600)*(effectiveXS*1e-24)+lam)*exposure
+            W = lam/(lam-(flux*3600)*(initialXS*1e-24)+(fluence*3600)*(effectiveXS*1e-24))
+            X = np.where(U > V, W*np.exp(-V)*np.expm1(V-U), -W*np.exp(-U)*np.expm1(U-V))
+            capture_activity = root*X
+
+        if (~beta & ~double & (capture_activity < 0)).any():
+            k = np.nonzero((~beta & ~double & (capture_activity < 0)).reshape(-1, len(index)))[1][0]
+            msg = "activity %g less than zero for %s"%(
+                capture_activity.flat[k], self.results[index[k]].isotope)
+            raise RuntimeError(msg)
+        activity = np.where(beta, b_activity, np.where(double, n2_activity, capture_activity))
+        # Fast reactions are suppressed when there is no fast ratio.
+        return np.where(fast & (fast_ratio == 0), 0., activity)
+
+_activation_table = None
+_activation_table_lock = threading.Lock()
+def activation_table():
+    """
+    Return the shared ActivationTable, building it on first use.
+    """
+    global _activation_table
+    with _activation_table_lock:
+        if _activation_table is None:
+            load_table('activation', 'activation data',
+                       lambda: elements.Co[59].neutron_activation)
+            start = time.perf_counter()
+            _activation_table = ActivationTable()
+            record_load('activation', 'activation table', time.perf_counter() - start)
+    return _activation_table
+
+def decay_times(activity, rest_times, targets):
+    """
+    Hours after the end of exposure until the total activity falls below
+    each of the *targets* (uCi).
+
+    This replaces activation.Sample.decay_time, solving for all targets
+    at once from the activity of each product at the earliest rest time
+    and the product decay constants.  Returns a list of times.
+    """
+    if not rest_times or not activity:
+        return [0]*len(targets)
+    k = min(range(len(rest_times)), key=lambda i: rest_times[i])
+    # Drop products with no activity since log(0) breaks the bracket.
+    data = [(levels[k], LN2/el.Thalf_hrs) for el, levels in activity.items()
+            if levels[k] > 0.0]
+    if not data:
+        return [0]*len(targets)
+    A, lam = (np.array(v, dtype='d') for v in zip(*data))
+    t = solve_decay_time(A, lam, np.asarray(targets, dtype='d'),
+                         t_min=-rest_times[k])
+    return (t + rest_times[k]).tolist()
+
+def sweep_decay_times(products, levels, rest_times, targets):
+    """
+    Hours after the end of exposure until the total activity falls below
+    each of the *targets* (uCi), for every point of a sweep.
+
+    *levels* is the activity grid returned by ActivationTable.sweep for
+    *products*.  Returns an array with the shape of the sweep grid and the
+    targets in the last dimension.
+    """
+    grid = levels.shape[1:-1]
+    times = np.zeros(grid + (len(targets),))
+    if not rest_times or not products:
+        return times
+    k = min(range(len(rest_times)), key=lambda i: rest_times[i])
+    lam = LN2/np.array([el.Thalf_hrs for el in products], dtype='d')
+    A = np.moveaxis(levels[..., k], 0, -1).reshape(-1, len(products))
+    # Grid points with no activity are left at zero, as in decay_times.
+    active = (A > 0).any(axis=-1)
+    if active.any():
+        t = solve_decay_time(A[active][:, None, :], lam,
+                             np.asarray(targets, dtype='d'), t_min=-rest_times[k])
+        times.reshape(-1, len(targets))[active] = t + rest_times[k]
+    return times
+
+def solve_decay_time(A, lam, target, t_min=0.0, tol=1e-12, max_iter=200):
+    r"""
+    Solve $\sum_i A_i e^{-\lambda_i t} = T$ for $t \geq t_{\rm min}$.
+
+    *A* has the activity of each product in the last dimension, with any
+    leading dimensions broadcast against the *target* activity $T$, so
+    that many targets and many activity vectors can be solved together.
+    *lam* is the decay constant of each product.
+
+    The log of the total activity is a convex decreasing function of time,
+    so Newton steps started to the left of the root never pass it.  The
+    start is the latest time at which any single product is still above
+    the target, which is a lower bound on the solution.  The bracket is
+    closed by the time when every product is below target/n, so that the
+    Newton iteration begins within a few decay lengths of the root.
+    """
+    with np.errstate(divide='ignore'):
+        logA = np.log(A)
+    logT = np.log(target)
+    shape = np.broadcast_shapes(logA.shape[:-1], logT.shape)
+    logA = np.broadcast_to(logA, shape + logA.shape[-1:])
+    logT = np.broadcast_to(logT, shape)
+
+    def g(t):
+        """log of total activity minus log target, and its derivative"""
+        z = logA - lam*t[..., None]
+        zmax = z.max(axis=-1)
+        w = np.exp(z - zmax[..., None])
+        wsum = w.sum(axis=-1)
+        return np.log(wsum) + zmax - logT, -(w*lam).sum(axis=-1)/wsum
+
+    n = A.shape[-1]
+    single = (logA - logT[..., None])/lam
+    lo = np.maximum(single.max(axis=-1), t_min)
+    hi = np.maximum(single.max(axis=-1) + log(n)/lam.min(), lo)
+    g_lo, dg_lo = g(lo)
+    below = g_lo <= 0  # already below target at t_min
+    for _ in range(max_iter):
+        step = np.where(g_lo > tol, -g_lo/dg_lo, 0.0)
+        if not (step > tol*np.maximum(1.0, abs(lo))).any():
+            break
+        lo = np.minimum(lo + step, hi)
+        g_lo, dg_lo = g(lo)
+    g_lo, _ = g(lo)
+    percent_error = 100*abs(np.expm1(g_lo[~below])).max(initial=0.0)
+    if percent_error > 0.1:
+        msg = (
+            "Failed to compute decay time correctly (%.1g error). Please"
+            " report material, mass, flux and exposure.") % percent_error
+        raise RuntimeError(msg)
+    return lo
+
+def compare_decay_solvers(chem, mass, activity, rest_times, targets, solve_time):
+    """
+    Time activation.Sample.decay_time on the same problem as decay_times
+    for comparison.  Returns the timing for both, along with the reference
+    solution.
+    """
+    activation = load_module('activation', 'periodictable.activation')
+    sample = activation.Sample(chem, mass=mass)
+    sample.activity, sample.rest_times = activity, rest_times
+    start = time.perf_counter()
+    try:
+        reference = [sample.decay_time(target) for target in targets]
+    except Exception:
+        reference = error()
+    return {
+        'seconds': solve_time,
+        'reference_seconds': time.perf_counter() - start,
+        'reference': reference,
+    }
+
+def calculate_sample(spec, cond):
+    """
+    Compute the sample, activation and scattering sections of the response
+    for a parsed sample *spec* under conditions *cond*.
+    """
+    sample, chem, mass, thickness = (
+        spec['sample'], spec['chem'], spec['mass'], spec['thickness'])
+    derived = spec['derived']
+    density_type, density_value = spec['density']
+    calculate = cond['calculate']
+
     # Fill in defaults
     #print >>sys.stderr,density_type,density_value,chem.density
     if density_type == 'default' or density_value == 0:
@@ -369,7 +1522,7 @@ def cgi_call(form):
         if chem.density is None:
             chem.density = 1
     elif density_type == 'volume':
-        chem.density = chem.molecular_mass/density_value
+        chem.density = derived['molecular_mass']/density_value
     elif density_type == 'natural':
         # if density is given, assume it is for natural abundance
         chem.natural_density = density_value
@@ -388,117 +1541,322 @@ def cgi_call(form):
         else:
             mass = 1.
 
-    result = {
-        'success': True,
-        'version': periodictable.__version__,
-        }
+    result = {}
     result['sample'] = {
         'name': sample,
-        'formula': str(chem),
+        'formula': derived['formula'],
         # Use latex output with "$_{count}" rather than html "<sub>count</sub>"
         # because html translates "<" to "&lt;" and then to "&amp;lt". Instead
         # use sample.formula_latex.replace(/\$_{([^}]*)}\$/g, '<sub>$1</sub>')
         # to render subscripts in the web interface.
-        'formula_latex': periodictable.formulas.pretty(chem, 'latex'),
+        'formula_latex': derived['latex'],
         'mass': mass,
         'density': chem.density,
         'thickness': thickness,
-        'natural_density': chem.natural_density,
+        'natural_density': (
+            derived['natural_density'] if chem.density == derived['density']
+            else chem.natural_density),
         }
 
     # Run calculations
-    if calculate in ('activation', 'all'):
-        try:
-            env = activation.ActivationEnvironment(fluence=fluence,
-                                                   fast_ratio=fast_ratio,
-                                                   Cd_ratio=Cd_ratio)
-            sample = activation.Sample(chem, mass=mass)
-            sample.calculate_activation(env,
-                                        exposure=exposure,
-                                        rest_times=rest_times,
-                                        abundance=abundance)
-            decay_time = sample.decay_time(decay_level)
-            total = [0]*len(sample.rest_times)
-            rows = []
-            for el, activity_el in sample.activity.items():
-                total = [t+a for t, a in zip(total, activity_el)]
-                rows.append({
-                    'isotope': el.isotope, 'reaction': el.reaction,
-                    'product': el.daughter, 'halflife': el.Thalf_str,
-                    'comments': el.comments, 'levels': activity_el,
-                    })
-            result['activation'] = {
-                'flux': fluence,
-                'fast': fast_ratio,
-                'Cd': Cd_ratio,
-                'exposure': exposure,
-                'rest': rest_times,
-                'activity': rows,
-                'total': total,
-                'decay_level': decay_level,
-                'decay_time': decay_time,
-            }
-        except Exception:
-            result['activation'] = {"error": error()}
-
+    sections = []
+    if calculate in ('activation', 'all') and cond['sweep'] is not None:
+        sections.append(('sweep', sweep_section, (chem, mass, derived, cond)))
+    elif calculate in ('activation', 'all'):
+        sections.append(('activation', activation_section, (chem, mass, derived, cond)))
     #nsf_sears.replace_neutron_data()
     if calculate in ('scattering', 'all'):
+        sections.append(('scattering', scattering_section, (chem, thickness, cond)))
+        sections.append(('xray_scattering', xray_section, (chem, cond)))
+    result.update(run_sections(sections))
+    #print("result", result, file=sys.stderr)
+
+    return result
+
+_section_pool = None
+_section_slots = None
+_section_pool_lock = threading.Lock()
+def section_pool():
+    """
+    Return the thread pool shared by all requests for evaluating sections.
+    """
+    global _section_pool, _section_slots
+    with _section_pool_lock:
+        if _section_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _section_pool = ThreadPoolExecutor(
+                max_workers=SECTION_WORKERS, thread_name_prefix='nact-section')
+            _section_slots = threading.BoundedSemaphore(SECTION_WORKERS)
+    return _section_pool
+
+def _submit_section(fn, args):
+    """
+    Start *fn(\*args)* on a section thread, returning a future, or return
+    None if there is no idle worker.
+    """
+    from concurrent.futures import Future
+    if SECTION_DAEMON:
+        future = Future()
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as exc:
+                    future.set_exception(exc)
+        threading.Thread(target=run, name='nact-section', daemon=True).start()
+        return future
+    pool = section_pool()
+    if not _section_slots.acquire(blocking=False):
+        return None
+    future = pool.submit(fn, *args)
+    future.add_done_callback(lambda _: _section_slots.release())
+    return future
+
+def run_sections(sections):
+    """
+    Evaluate the response *sections* concurrently.
+
+    *sections* is a list of (name, function, args).  Each function catches
+    its own errors and returns the section of the response.  A section which
+    does not complete within SECTION_TIMEOUT seconds is reported as an error
+    with *timeout* set, and the remaining sections are returned without it.
+    The timed out calculation continues in the background until it finishes.
+
+    Sections are only given to the shared pool if it has an idle worker.
+    Otherwise they are computed in this thread, with no timeout, once the
+    other sections have been started.
+    """
+    from concurrent.futures import TimeoutError as FutureTimeout
+    if len(sections) == 1 or not SECTION_THREADS:
+        return dict((name, fn(*args)) for name, fn, args in sections)
+    deadline = time.time() + SECTION_TIMEOUT
+    futures = [(name, _submit_section(fn, args), fn, args)
+               for name, fn, args in sections]
+    result = {}
+    for name, future, fn, args in futures:
+        if future is None:
+            result[name] = fn(*args)
+    for name, future, fn, args in futures:
+        if future is None:
+            continue
         try:
-            sld, xs, penetration = neutron_scattering(chem, wavelength=wavelength)
+            result[name] = future.result(timeout=max(deadline - time.time(), 0))
+        except FutureTimeout:
+            msg = "%s calculation did not complete in %g s"%(name, SECTION_TIMEOUT)
+            result[name] = {'error': msg, 'timeout': True}
+    return dict((name, result[name]) for name, _, _ in sections)
+
+def activation_section(chem, mass, derived, cond):
+    """
+    Activation section of the response.
+    """
+    try:
+        activation = load_module('activation', 'periodictable.activation')
+        env = activation.ActivationEnvironment(
+            fluence=cond['fluence'],
+            fast_ratio=cond['fast_ratio'],
+            Cd_ratio=cond['Cd_ratio'])
+        rest_times, decay_levels = cond['rest_times'], cond['decay_levels']
+        timer = cond['timer']
+        with timer.stage('activation'):
+            activity = activation_table().activity(
+                chem, mass, env, exposure=cond['exposure'],
+                rest_times=rest_times, abundance=getattr(activation, cond['abundance']),
+                mass_fraction=derived['mass_fraction'])
+        solve_start = time.perf_counter()
+        decay_time = decay_times(activity, rest_times, decay_levels)
+        solve_time = time.perf_counter() - solve_start
+        timer.add('decay_time', solve_time)
+        total = [0]*len(rest_times)
+        rows = []
+        for el, activity_el in activity.items():
+            total = [t+a for t, a in zip(total, activity_el)]
+            rows.append({
+                'isotope': el.isotope, 'reaction': el.reaction,
+                'product': el.daughter, 'halflife': el.Thalf_str,
+                'comments': el.comments, 'levels': activity_el,
+                })
+        section = {
+            'flux': cond['fluence'],
+            'fast': cond['fast_ratio'],
+            'Cd': cond['Cd_ratio'],
+            'exposure': cond['exposure'],
+            'rest': rest_times,
+            'activity': rows,
+            'total': total,
+            'decay_level': decay_levels[0],
+            'decay_time': decay_time[0],
+        }
+        if len(decay_levels) > 1:
+            section['decay_levels'] = decay_levels
+            section['decay_times'] = decay_time
+        if 'decay' in cond['debug']:
+            section['decay_solver'] = compare_decay_solvers(
+                chem, mass, activity, rest_times, decay_levels, solve_time)
+        if cond['curve'] is not None:
+            with timer.stage('decay_curve'):
+                section['curve'] = decay_curve(activity, rest_times, cond['curve'])
+        return section
+    except Exception:
+        return {"error": error()}
+
+def sweep_section(chem, mass, derived, cond):
+    """
+    Activation section of the response for a sweep over the grid of
+    conditions in *cond['sweep']*.
+    """
+    try:
+        activation = load_module('activation', 'periodictable.activation')
+        sweep = cond['sweep']
+        rest_times, decay_levels = cond['rest_times'], cond['decay_levels']
+        timer = cond['timer']
+        with timer.stage('activation'):
+            products, levels = activation_table().sweep(
+                chem, mass, sweep['flux'], sweep['exposure'], sweep['fast'],
+                sweep['Cd'], rest_times=rest_times,
+                abundance=getattr(activation, cond['abundance']),
+                mass_fraction=derived['mass_fraction'])
+        with timer.stage('decay_time'):
+            decay_time = sweep_decay_times(products, levels, rest_times, decay_levels)
+        rows = [{
+            'isotope': el.isotope, 'reaction': el.reaction,
+            'product': el.daughter, 'halflife': el.Thalf_str,
+            'comments': el.comments, 'levels': levels_el,
+            } for el, levels_el in zip(products, levels.tolist())]
+        section = OrderedDict(sweep)
+        section.update({
+            'rest': rest_times,
+            'shape': [len(v) for v in sweep.values()],
+            'activity': rows,
+            'total': levels.sum(axis=0).tolist(),
+            'decay_level': decay_levels[0],
+            'decay_time': decay_time[..., 0].tolist(),
+        })
+        if len(decay_levels) > 1:
+            section['decay_levels'] = decay_levels
+            section['decay_times'] = decay_time.tolist()
+        return section
+    except Exception:
+        return {"error": error()}
+
+def scattering_section(chem, thickness, cond):
+    """
+    Neutron scattering section of the response.
+    """
+    wavelength = cond['wavelength']
+    try:
+        nsf = load_module('scattering', 'periodictable.nsf')
+        load_table('scattering', 'neutron table', lambda: elements.H.neutron)
+        with cond['timer'].stage('scattering'):
+            sld, xs, penetration = nsf.neutron_scattering(chem, wavelength=wavelength)
             # CRUFT: periodictable < 1.5.3 does not define D2O_match
             if hasattr(nsf, 'D2O_match'):
                 D2O_fraction, D2O_sld = nsf.D2O_match(chem)
             else:
                 D2O_fraction, D2O_sld = None, None
-            result['scattering'] = {
-                'neutron': {
-                    'wavelength': wavelength,
-                    'energy': nsf.neutron_energy(wavelength),
-                    'velocity': nsf.VELOCITY_FACTOR/wavelength,
-                },
-                'xs': {'coh': xs[0], 'abs': xs[1], 'incoh': xs[2]},
-                'sld': {'real': sld[0], 'imag': sld[1], 'incoh': sld[2]},
-                'penetration': penetration,
-                'transmission': 100*exp(-thickness/penetration),
-                'contrast_match': {
-                    'D2O_fraction': D2O_fraction,
-                    'sld': D2O_sld,
-                },
-            }
-        except Exception:
-            missing = [str(el) for el in chem.atoms if not el.neutron.has_sld()]
-            if any(missing):
-                msg = "missing neutron cross sections for "+", ".join(missing)
-            else:
-                msg = error()
-            result['scattering'] = {'error': msg}
-
-
-        try:
-            xsld = xray_sld(chem, wavelength=xray_wavelength)
-            result['xray_scattering'] = {
-                'xray': {
-                    'wavelength': xray_wavelength,
-                    'energy': xsf.xray_energy(xray_wavelength),
-                },
-                'sld': {'real': xsld[0], 'imag': xsld[1]},
-            }
-        except Exception:
-            result['xray_scattering'] = {'error': error()}
-    #print("result", result, file=sys.stderr)
+        return {
+            'neutron': {
+                'wavelength': wavelength,
+                'energy': nsf.neutron_energy(wavelength),
+                'velocity': nsf.VELOCITY_FACTOR/wavelength,
+            },
+            'xs': {'coh': xs[0], 'abs': xs[1], 'incoh': xs[2]},
+            'sld': {'real': sld[0], 'imag': sld[1], 'incoh': sld[2]},
+            'penetration': penetration,
+            'transmission': 100*exp(-thickness/penetration),
+            'contrast_match': {
+                'D2O_fraction': D2O_fraction,
+                'sld': D2O_sld,
+            },
+        }
+    except Exception:
+        missing = [str(el) for el in chem.atoms if not el.neutron.has_sld()]
+        if any(missing):
+            msg = "missing neutron cross sections for "+", ".join(missing)
+        else:
+            msg = error()
+        return {'error': msg}
 
-    return result
+def xray_section(chem, cond):
+    """
+    X-ray scattering section of the response.
+    """
+    xray_wavelength = cond['xray_wavelength']
+    try:
+        xsf = load_module('xray_scattering', 'periodictable.xsf')
+        with cond['timer'].stage('xray'):
+            xsld = xsf.xray_sld(chem, wavelength=xray_wavelength)
+        return {
+            'xray': {
+                'wavelength': xray_wavelength,
+                'energy': xsf.xray_energy(xray_wavelength),
+            },
+            'sld': {'real': xsld[0], 'imag': xsld[1]},
+        }
+    except Exception:
+        return {'error': error()}
 
 
-if __name__ == "__main__":
+def handle_request(form):
+    """
+    Run the calculation for *form*, turning unexpected exceptions into
+    an error response.
+    """
+    start = time.perf_counter()
     try:
-        form = cgi.FieldStorage()
-        response = cgi_call(form)
+        result = cgi_call(form)
+        metrics.count_request('success' if result['success'] else 'invalid')
     except Exception:
-        response = {
+        result = {
             'success': False,
             'version': periodictable.__version__,
             'detail': {'query': error()},
             'error': 'unexpected exception',
         }
-    respond(response)
+        metrics.count_request('error')
+    metrics.observe('request', time.perf_counter() - start)
+    return result
+
+class FakeFieldStorage(dict):
+    """
+    Dictionary with the cgi.FieldStorage interface used by cgi_call.
+
+    This allows cgi_call to be driven directly from python, for example
+    when the calculator is running in a long-lived server process or in
+    the browser (see FakeFieldStorage in activation/webworker.js).
+    """
+    def getfirst(self, name, default=None):
+        rval = self.get(name, default)
+        if isinstance(rval, (list, tuple)):
+            rval = rval[0] if rval else default
+        return rval if rval != "" else default
+    def getlist(self, name):
+        if name not in self:
+            name = re.sub(r"\[\]$", "", name)
+        rval = self.get(name, [])
+        if isinstance(rval, (str, bytes)):
+            return [rval]
+        return list(rval)
+
+def warmup():
+    """
+    Load the activation, neutron and xray tables before the first request.
+
+    Periodictable loads its data tables on first use, so a long-running
+    server should call this at startup to keep table loading out of the
+    response time for the first user.
+    """
+    activation_table()
+    result = cgi_call(FakeFieldStorage(sample='Co', calculate='all'))
+    # Keep the warmup request out of the served metrics.
+    metrics.clear()
+    return result
+
+if __name__ == "__main__":
+    import cgi
+    SECTION_DAEMON = True
+    form = cgi.FieldStorage()
+    if wants_stream(form):
+        ndjson_response(stream_request(form))
+    else:
+        respond(handle_request(form))
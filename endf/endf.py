@@ -32,6 +32,26 @@ Run using::
     python ../endf.py ../ENDF-B-VII.1/*.zip
 
 This produces a set of "*.out" files containing the interpolated data.
+The PREPRO programs read and write fixed file names in the current
+directory, so only one isotope can be processed at a time in a directory.
+To process the library on several cores use::
+
+    python ../endf.py --interp --jobs 8 ../ENDF-B-VII.1/*.zip
+
+Each isotope is then run in a scratch directory of its own beside the
+output, and the finished ".out" file is moved into place, so partial
+outputs are never left under the final name.  Isotopes which fail are
+listed at the end, with the scratch directory kept for inspection.
+Use "--jobs 0" for one job per cpu.
+
+The outputs are recorded in endf-manifest.json in the output directory,
+along with the hash of the input file, the processing steps in PIPELINE
+with their parameters and input decks, and the hashes of the PREPRO
+programs.  Only outputs which are missing, incomplete, or out of date
+with respect to their input, the pipeline or the programs are rebuilt,
+so after an interrupted run or a library update the same command picks
+up where it left off.
+
 You can plot individual resonances using, e.g.:
 
     python ../endf.py --pyplot *Sm-144*.out
@@ -39,6 +59,35 @@ You can plot individual resonances using, e.g.:
 The plotter is set to plot the elastic cross section (column 2) and the
 capture cross section (column 102). See *ENDF_COLUMNS* for the column names.
 
+The cross sections are read with endf_read_tab1, which parses each table
+in bulk with numpy.  To check it against the original line by line reader,
+endf_read1d, on a set of files use::
+
+    python ../endf.py --check-reader *.out
+
+Files which endf_read1d cannot read, such as PREPRO output without an
+"E" in the exponent, are reported as failures.  To check the readers
+without any ENDF data use::
+
+    python endf.py --self-test
+
+Each output gets an index of the byte offset and size of its sections,
+saved beside it as "*.out.idx", so that only the requested sections are
+read.  The index is rebuilt automatically if the output changes.
+
+The cross sections can also be converted into a binary store, with the
+energy and value arrays of each section stored contiguously as float64
+in "endf-xs.dat" and the isotope metadata and array offsets in
+"endf-xs.json"::
+
+    python ../endf.py --build-store *.out
+    python ../endf.py --pyplot --store endf-xs
+
+The store is memory mapped by XSStore, so the tables are used without
+parsing any text.  Files not in the store, or which have changed since
+the store was built, are read from the ".out" file.  Rebuild the store
+after reprocessing the outputs.
+
 To generate the images used on the web modify the code, uncommenting the
 lines labeled "For resonance.html". Then run with all interpolated data::
 
@@ -60,9 +109,15 @@ import sys
 import os
 import math
 import shutil
+import io
 import zipfile
 import glob
+import json
+import time
+import hashlib
+import tempfile
 import warnings
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -85,6 +140,8 @@ ROOT = os.path.abspath(os.path.dirname(__file__))
 ENDF_PROGRAMS = os.path.join(ROOT, "MAC")
 ENDF_DATA = os.path.join(ROOT,"ENDF-B-VIII.1")
 KEEP_INTERMEDIATES = False
+MANIFEST = "endf-manifest.json"
+STORE = "endf-xs"
 
 # See sec 3.4 and Appendix B of the ENDF manual
 # https://www.oecd-nea.org/dbdata/data/endf102.htm#LinkTarget_11914
@@ -129,6 +186,22 @@ ENDF_DELTA = {
     108: (-4, -3), # n,2a
 }
 
+# PREPRO steps applied by run_endf, in order, as (program, parameters).
+# Each step writes its input deck using the function named program_input.
+# Changing this list, the parameters or the input decks marks the existing
+# outputs as out of date (see BuildManifest).
+PIPELINE = [
+    ("linear", {"MTs": None}),  # must be first
+    ("recent", {"range": None}),  # add resonances
+    ("sigma1", {"T": 293.16}),  # set temperature to 20 C
+    ("activate", {}),
+    #("legend", {}),
+    #("sixpak", {}),
+    #("spectra", {}),
+    ("fixup", {}),
+    ("dictin", {}),
+]
+
 def _next_step(step, name):
     if KEEP_INTERMEDIATES:
         return f"STEP-{step}-{name}.OUT"
@@ -139,6 +212,10 @@ def _efmt(val,width,digits):
     tens = 0 if val==0 else math.floor(math.log10(abs(val)))
     return "%*.*f%+03d"%(width-3,digits,val/10**tens,tens)
 
+def _write_input(filename, deck):
+    with open(filename, "w") as fid:
+        fid.write(deck)
+
 def _run(prog, files):
     if os.system(os.path.join(ENDF_PROGRAMS, prog)) != 0:
         raise RuntimeError(f"error in '{prog}'")
@@ -147,53 +224,50 @@ def _run(prog, files):
             if os.path.exists(f): os.unlink(f)
     print(f":======== Done {prog} ========", file=sys.stderr)
 
-def linear(infile, step, MTs=None):
+def linear_input(infile, outfile, MTs=None):
     """
-    run the endf program LINEAR to set up simple linear
-    interpolation throughout the entire range
-
-    *MTs* is the list of MTs to interpolate, or None for all.
+    input deck for LINEAR; see linear
     """
-    outfile, step = _next_step(step, "LINEAR")
     selection_criteria = 0 # 0:MAT, 1:ZA
     monitor = 0 # 0:quiet, 1: noisy
     min_xs = 1e-10 # minimum cross section, or 0 if 1e-10
     keep_points = 1 # 0:keep only interpolated points, 1: keep original and interpolated
-    with open("LINEAR.INP","w") as fid:
-        fid.write(" %10d%10d%s%10d\n"
-                  %(selection_criteria, monitor, _efmt(min_xs,10,4), keep_points))
-        fid.write(f"{infile}\n{outfile}\n")
-        if MTs:
-            for c in MTs:
-                fid.write(f"     0 0{c:3d}99999999{c:3d}\n")
-        else:
-            fid.write("     0 0  099999999999\n") # do everything
-        fid.write("""\
+    deck = (" %10d%10d%s%10d\n"
+            %(selection_criteria, monitor, _efmt(min_xs,10,4), keep_points))
+    deck += f"{infile}\n{outfile}\n"
+    if MTs:
+        for c in MTs:
+            deck += f"     0 0{c:3d}99999999{c:3d}\n"
+    else:
+        deck += "     0 0  099999999999\n" # do everything
+    deck += """\
                         (BLANK CARD TERMINATES MAT REQUEST RANGES)
  0.00000-00 1.00000-04
                         (BLANK CARD TERMINATES FILE 3 ERROR LAW)
-""")
-    _run("linear",["LINEAR.INP","LINEAR.LST"])
-    return outfile, step
+"""
+    return deck
 
-def recent(infile, step, range=None):
+def linear(infile, step, MTs=None):
     """
-    run the endf program RECENT to add resonance effects to the
-    cross sections.
+    run the endf program LINEAR to set up simple linear
+    interpolation throughout the entire range
 
-    This is only needed for a few cross sections in the thermal
-    neutron range.
+    *MTs* is the list of MTs to interpolate, or None for all.
+    """
+    outfile, step = _next_step(step, "LINEAR")
+    _write_input("LINEAR.INP", linear_input(infile, outfile, MTs))
+    _run("linear",["LINEAR.INP","LINEAR.LST"])
+    return outfile, step
 
-    *range* is None or [min, max] in eV.  If running ranges in
-    sections, always run from lowest to highest.
+def recent_input(infile, outfile, range=None):
+    """
+    input deck for RECENT; see recent
     """
-    outfile, step = _next_step(step, "RESONANCE")
     if range is not None:
         rangestr = _efmt(range[0], 10, 5) + _efmt(range[1], 10, 5)
     else:
         rangestr = ""
-    with open("RECENT.INP","w") as fid:
-        fid.write(f"""\
+    return f"""\
           0 1.00000-10          1          1          1          1
 {infile}
 {outfile}
@@ -204,19 +278,30 @@ def recent(infile, step, range=None):
  2.00000+00 1.00000-03
  2.00000+07 1.00000-03
                         (BLANK CARD TERMINATES FILE 3 ERROR LAW)
-""")
+"""
+
+def recent(infile, step, range=None):
+    """
+    run the endf program RECENT to add resonance effects to the
+    cross sections.
+
+    This is only needed for a few cross sections in the thermal
+    neutron range.
+
+    *range* is None or [min, max] in eV.  If running ranges in
+    sections, always run from lowest to highest.
+    """
+    outfile, step = _next_step(step, "RESONANCE")
+    _write_input("RECENT.INP", recent_input(infile, outfile, range))
     _run("recent", ["RECENT.INP", "RECENT.LST"])
     return outfile, step
 
-def sigma1(infile, step, T=293.6):
+def sigma1_input(infile, outfile, T=293.6):
     """
-    run the endf program SIGMA1 to adjust the temperature of the
-    sample, applying doppler broadening to the resonance peaks.
+    input deck for SIGMA1; see sigma1
     """
-    outfile, step = _next_step(step, "SIGMA1")
     temperature_str = _efmt(T, 10, 5)
-    with open("SIGMA1.INP", "w") as fid:
-        fid.write(f"""\
+    return f"""\
           0          0{temperature_str}  1.00000-10          1          0
 {infile}
 {outfile}
@@ -227,42 +312,58 @@ def sigma1(infile, step, T=293.6):
  2.00000+ 0 1.00000-03
  2.00000+ 7 1.00000-03
                        (BLANK CARD TERMINATES FILE 3 ERROR LAW)
-""")
+"""
+
+def sigma1(infile, step, T=293.6):
+    """
+    run the endf program SIGMA1 to adjust the temperature of the
+    sample, applying doppler broadening to the resonance peaks.
+    """
+    outfile, step = _next_step(step, "SIGMA1")
+    _write_input("SIGMA1.INP", sigma1_input(infile, outfile, T))
     _run("sigma1",["SIGMA1.INP", "SIGMA1.LST"])
     return outfile, step
 
+def activate_input(infile, outfile):
+    """
+    input deck for ACTIVATE; see activate
+    """
+    return f"{infile}\n{outfile}\n"
+
 def activate(infile, step):
     """
     run the endf program ACTIVATE to set activation cross sections
     """
     outfile, step = _next_step(step, "ACTIVATE")
-    with open("ACTIVATE.INP","w") as fid:
-        fid.write(f"{infile}\n{outfile}\n")
+    _write_input("ACTIVATE.INP", activate_input(infile, outfile))
     _run("activate", ["ACTIVATE.INP", "ACTIVATE.LST"])
     return outfile, step
 
-def legend(infile, step):
+def legend_input(infile, outfile):
     """
-    run the endf program LEGEND to set legendre interpolation
+    input deck for LEGEND; see legend
     """
-    outfile, step = _next_step(step, "LEGEND")
-    with open("LEGEND.INP", "w") as fid:
-        fid.write(f"""\
+    return f"""\
  1.00000-02      20000          2          1          2          0
 {infile}
 {outfile}
      0 0  0  999999999 0.00000+00 1.00000+09 1.00000-03 1.00000-02
-""")
+"""
+
+def legend(infile, step):
+    """
+    run the endf program LEGEND to set legendre interpolation
+    """
+    outfile, step = _next_step(step, "LEGEND")
+    _write_input("LEGEND.INP", legend_input(infile, outfile))
     _run("legend", ["LEGEND.INP", "LEGEND.LST", "LEGEND.TMP"])
     return outfile, step
 
-def fixup(infile, step):
+def fixup_input(infile, outfile):
     """
-    run the endf program FIXUP to clean up summed columns
+    input deck for FIXUP; see fixup
     """
-    outfile, step = _next_step(step, "FIXUP")
-    with open("FIXUP.INP", "w") as fid:
-        fid.write(f"""\
+    return f"""\
 10002111111001          (col. 11 = 1 = allow MT reconstruction)
 {infile}
 {outfile}
@@ -282,18 +383,29 @@ def fixup(infile, step):
  0.0       0.0                  0          0
  0.0       0.0                  0          0   0107  (total n,alpha)
  0.0       0.0                  0          0
-""")
+"""
 
+def fixup(infile, step):
+    """
+    run the endf program FIXUP to clean up summed columns
+    """
+    outfile, step = _next_step(step, "FIXUP")
+    _write_input("FIXUP.INP", fixup_input(infile, outfile))
     _run("fixup",["FIXUP.INP","FIXUP.LST"])
     return outfile, step
 
+def dictin_input(infile, outfile):
+    """
+    input deck for DICTIN; see dictin
+    """
+    return f"{infile}\n{outfile}\n"
+
 def dictin(infile, step):
     """
     run DICTIN to update ENDF dictionary
     """
     outfile, step = _next_step(step, "DICTIN")
-    with open("DICTIN.INP", "w") as fid:
-        fid.write(f"{infile}\n{outfile}\n")
+    _write_input("DICTIN.INP", dictin_input(infile, outfile))
     _run("dictin", ["DICTIN.INP", "DICTIN.LST"])
     return outfile, step
 
@@ -373,7 +485,158 @@ def endf_read1d(head, fid):
     line = fid.readline() # skip the "SEND" record
     return [np.array(v) for v in zip(*pairs)]
 
+def endf_floats(fields):
+    """
+    Convert an array of ENDF 11 character numeric fields (dtype S11) to
+    floats.
+
+    ENDF numbers are Fortran style, with the exponent usually written
+    without an "E", as in "1.234567+5" or "-2.5-12", and sometimes with
+    a space after the sign, as in "1.00000+ 0".  The missing "E" is
+    inserted for all fields at once before the numpy conversion to float.
+    """
+    n, width = len(fields), fields.dtype.itemsize
+    chars = fields.view(np.uint8).reshape(n, width)
+    sign = (chars == ord('+')) | (chars == ord('-'))
+    # Remove the space after an exponent sign by moving the spaces in those
+    # fields to the end, keeping the other characters in order.  This is
+    # rare, so only the fields which need it are rearranged.
+    gap = (sign[:, :-1] & (chars[:, 1:] == ord(' '))).any(axis=1)
+    if gap.any():
+        chars = chars.copy()
+        rows = chars[gap]
+        order = np.argsort(rows == ord(' '), axis=1, kind='stable')
+        chars[gap] = np.take_along_axis(rows, order, axis=1)
+        sign = (chars == ord('+')) | (chars == ord('-'))
+    # Exponent sign: a sign which follows a digit or a decimal point.
+    mantissa = ((chars >= ord('0')) & (chars <= ord('9'))) | (chars == ord('.'))
+    exponent = sign[:, 1:] & mantissa[:, :-1]
+    pos = np.where(exponent.any(axis=1), exponent.argmax(axis=1) + 1, width)
+    # The exponent is in the same column for most fields, so insert the
+    # "E" for each distinct column rather than field by field.
+    result = np.full((n, width + 1), ord(' '), dtype=np.uint8)
+    for p in np.unique(pos):
+        rows = pos == p
+        result[rows, :p] = chars[rows, :p]
+        if p < width:
+            result[rows, p] = ord('E')
+            result[rows, p+1:] = chars[rows, p:]
+    return result.view(f"S{width+1}").ravel().astype(float)
+
+def endf_read_tab1(head, fid):
+    """
+    Read the TAB1 record following the *head* line of an MF=3 section,
+    returning arrays (x, y).
+
+    This is a faster equivalent of endf_read1d for large sections.  The
+    lines of the data block are read together and all fields are parsed
+    in one pass with endf_floats.  It also handles interpolation tables
+    with more than one line.
+    """
+    line1 = fid.readline()
+    num_regions, num_pairs = int(line1[44:55]), int(line1[55:66])
+    # skip the interpolation table: NBT, INT pairs, three to a line
+    for _ in range((num_regions + 2)//3):
+        fid.readline()
+    lines = [fid.readline() for _ in range((num_pairs + 2)//3)]
+    fid.readline() # skip the "SEND" record
+    block = "".join(lines).encode("ascii")
+    if len(block) == 81*len(lines):
+        # Full 80 column records, so the data columns can be sliced out.
+        data = np.frombuffer(block, dtype=np.uint8).reshape(len(lines), 81)[:, :66]
+        block = np.ascontiguousarray(data).tobytes()
+    else:
+        block = "".join(line[:66].ljust(66) for line in lines).encode("ascii")
+    fields = np.frombuffer(block, dtype="S11")[:2*num_pairs]
+    values = endf_floats(fields)
+    return [values[0::2], values[1::2]]
+
+def build_index(infile):
+    """
+    Return [(MAT, MF, MT, offset, size, lines)] for each section of the
+    ENDF file *infile*, with the byte offset and size of the section.
+    The section ends with its "SEND" record, which is included.
+    """
+    sections = []
+    current, start, count = None, 0, 0
+    offset = 0
+    with open(infile, "rb") as fid:
+        for line in fid:
+            key = line[66:75]
+            if current is not None:
+                count += 1
+                if key[6:9] == b"  0": # SEND record ends the section
+                    sections.append((*current, start, offset + len(line) - start, count))
+                    current = None
+            elif key[6:9] != b"  0" and key.strip():
+                mat, mf, mt = int(key[0:4]), int(key[4:6]), int(key[6:9])
+                if mat > 0:
+                    current, start, count = (mat, mf, mt), offset, 1
+            offset += len(line)
+    return sections
+
+def endf_index(infile):
+    """
+    Return {(MAT, MF, MT): (offset, size, lines)} for the sections of the
+    ENDF file *infile*.
+
+    The index is kept beside the file as *infile*.idx, and is rebuilt if
+    it is missing or the file has changed since it was written.  If the
+    index cannot be saved it is rebuilt each time.
+    """
+    stat = os.stat(infile)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    index_file = infile + ".idx"
+    try:
+        with open(index_file) as fid:
+            saved = json.load(fid)
+        if saved["source"] == source:
+            return {tuple(v[:3]): tuple(v[3:]) for v in saved["sections"]}
+    except (OSError, ValueError, KeyError):
+        pass
+    sections = build_index(infile)
+    try:
+        tmp = index_file + ".tmp"
+        with open(tmp, "w") as fid:
+            json.dump({"source": source, "sections": sections}, fid, separators=(",", ":"))
+        os.replace(tmp, index_file)
+    except OSError:
+        pass
+    return {tuple(v[:3]): tuple(v[3:]) for v in sections}
+
 def endf_load(infile, columns):
+    """
+    Load the MF=3 cross sections from *infile* whose MF and MT columns,
+    as they appear in columns 71-75 of the ENDF record (e.g., " 3102"),
+    are in *columns*.  Returns {(MAT, MF, MT): (x, y)}.
+
+    The sections are found using the index from endf_index, so only the
+    requested sections are read.  If the index cannot be built, or does
+    not match the file, the whole file is read with endf_scan.
+    """
+    try:
+        result = {}
+        index = endf_index(infile)
+        with open(infile, "rb") as fid:
+            for key, (offset, size, _) in sorted(index.items(), key=lambda v: v[1]):
+                mat, mf, mt = key
+                if f"{mf:2d}{mt:3d}" in columns:
+                    fid.seek(offset)
+                    block = io.StringIO(fid.read(size).decode("ascii"))
+                    head = block.readline()
+                    if head[66:75] != f"{mat:4d}{mf:2d}{mt:3d}":
+                        raise ValueError(f"section index does not match {infile}")
+                    result[key] = endf_read_tab1(head, block)
+        return result
+    except (ValueError, IndexError, UnicodeDecodeError) as exc:
+        warnings.warn(f"{exc}; reading all of {infile}")
+        return endf_scan(infile, columns)
+
+def endf_scan(infile, columns):
+    """
+    Load the sections in *columns* by reading every line of *infile*.
+    This is endf_load without the index, used when the index is unusable.
+    """
     result = {}
     with open(infile, "r") as fid:
         while True:
@@ -385,7 +648,7 @@ def endf_load(infile, columns):
                 mat = int(line[66:70]) #material code
                 mf = int(line[70:72])
                 mt = int(line[72:75])
-                result[(mat, mf, mt)] = endf_read1d(line, fid)
+                result[(mat, mf, mt)] = endf_read_tab1(line, fid)
     return result
 
 def select(x,y,lo,hi):
@@ -393,13 +656,19 @@ def select(x,y,lo,hi):
     #print "selected", x[idx]
     return x[idx], y[idx]
 
-def xs_table(infile, columns):
+def xs_table(infile, columns, store=None):
     """
     Load the linear interpolation tables for a list of cross section.
+
+    If *store* is an XSStore containing *infile* then the cross sections
+    are taken from the store rather than read from the file.
     """
-    items = [f" 3{c:3d}" for c in columns]
-    data = endf_load(infile, items)
-    data = dict((k[2], v) for k, v in data.items())
+    if store is not None and infile in store:
+        data = store.sections(infile, columns)
+    else:
+        items = [f" 3{c:3d}" for c in columns]
+        data = endf_load(infile, items)
+        data = dict((k[2], v) for k, v in data.items())
     if not data:
         return None
     #print infile,[v[0].shape for v in data.values()]
@@ -419,6 +688,119 @@ def save_table(outfile, table, range=None):
         table = table[:,idx]
     np.savetxt(outfile, table.T)
 
+def build_store(files, path=STORE):
+    """
+    Convert the MF=3 cross sections from the ENDF output *files* into a
+    binary store for XSStore.
+
+    The energy and value arrays for each (isotope, MT) are written one
+    after the other as little-endian float64 to *path*.dat.  The index in
+    *path*.json gives, for each isotope, its Z, A, isomer flag, MAT,
+    natural abundance and the offset and length of each MT, in values
+    from the start of the data file.  Both files are written under a
+    temporary name and renamed, so an open store is not disturbed.
+
+    Isotopes are named by file name without the directory, so the file
+    names must be distinct.
+    """
+    names = [os.path.basename(f) for f in files]
+    duplicates = sorted(set(v for v in names if names.count(v) > 1))
+    if duplicates:
+        raise ValueError("duplicate file names for store: " + ", ".join(duplicates))
+    isotopes = {}
+    offset = 0
+    with open(path + ".dat.tmp", "wb") as fid:
+        for f in files:
+            index = endf_index(f)
+            items = sorted(set(f"{mf:2d}{mt:3d}" for _, mf, mt in index if mf == 3))
+            data = endf_load(f, items)
+            if not data:
+                print(f"no cross sections in {f}...skipping")
+                continue
+            symbol, iso = isotope_id(f)
+            stat = os.stat(f)
+            sections = {}
+            for (mat, _, mt), (x, y) in sorted(data.items()):
+                n = len(x)
+                fid.write(np.asarray(x, '<f8').tobytes())
+                fid.write(np.asarray(y, '<f8').tobytes())
+                sections[str(mt)] = [offset, n]
+                offset += 2*n
+            isotopes[os.path.basename(f)] = {
+                "symbol": symbol,
+                "Z": pt.elements.symbol(symbol).number if pt is not None else None,
+                "A": int(iso.rstrip('M')),
+                "isomer": iso.endswith('M'),
+                "MAT": mat,
+                "abundance": abundance(f) if pt is not None else None,
+                "source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+                "sections": sections,
+            }
+    with open(path + ".json.tmp", "w") as fid:
+        json.dump({"dtype": "<f8", "size": offset, "isotopes": isotopes},
+                  fid, indent=1, sort_keys=True)
+    os.replace(path + ".dat.tmp", path + ".dat")
+    os.replace(path + ".json.tmp", path + ".json")
+    return isotopes
+
+class XSStore:
+    """
+    Cross sections from the binary store written by build_store.
+
+    The data file is memory mapped, so opening the store only reads the
+    index, and the arrays returned by *sections* are views into the map
+    which are paged in as they are used.  Isotopes are named by the
+    file name of the ENDF output they came from, with or without the
+    directory.  If the name is the path to an existing file which has
+    changed since the store was built, the isotope is treated as missing
+    so that the cross sections are read from the file instead.
+    """
+    def __init__(self, path=STORE):
+        with open(path + ".json") as fid:
+            index = json.load(fid)
+        self.isotopes = index["isotopes"]
+        if index["size"]:
+            self.data = np.memmap(path + ".dat", dtype=index["dtype"], mode="r",
+                                  shape=(index["size"],))
+        else:
+            self.data = np.empty(0)
+
+    def __contains__(self, name):
+        entry = self.isotopes.get(os.path.basename(name))
+        if entry is None:
+            return False
+        if os.path.exists(name):
+            stat = os.stat(name)
+            if entry["source"] != {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}:
+                warnings.warn(f"{name} has changed since the store was built")
+                return False
+        return True
+
+    def __iter__(self):
+        return iter(self.isotopes)
+
+    def __len__(self):
+        return len(self.isotopes)
+
+    def info(self, name):
+        """Metadata for isotope *name* (Z, A, isomer, MAT, abundance, ...)."""
+        return self.isotopes[os.path.basename(name)]
+
+    def sections(self, name, columns=None):
+        """
+        Return {MT: (x, y)} for the MTs in *columns* which are available
+        for isotope *name*, or all MTs if *columns* is None.
+        """
+        sections = self.info(name)["sections"]
+        if columns is None:
+            columns = [int(mt) for mt in sections]
+        result = {}
+        for mt in columns:
+            if str(mt) in sections:
+                offset, n = sections[str(mt)]
+                result[mt] = (self.data[offset:offset+n], self.data[offset+n:offset+2*n])
+        return result
+
 def expand_zip(infile):
     archive = zipfile.ZipFile(infile)
     members = archive.infolist()
@@ -664,40 +1046,173 @@ def showplot(x_data="energy", y_data="cross section", show=True):
         #for i,h in enumerate(FIGURES): h.savefig('figure_%d.png'%(i+1))
         pylab.show()
 
-def run_endf(infile, outfile=None):
-    out, step = infile, 1
+def endf_source(infile):
+    """
+    Return the ENDF file for *infile*, which is either a file name or an
+    isotope such as "Sm-149" to look up in ENDF_DATA.
+    """
     if '.' not in infile: # isotope
-        #if not outfile:
-        #    outfile = infile+".out"
         pattern = os.path.join(ENDF_DATA, f"*-{infile}.zip")
         match = list(glob.glob(pattern))
         if len(match) != 1:
             raise RuntimeError(f"'{infile}' is not an isotope")
         infile = match[0]
+    return infile
+
+def default_outfile(infile):
+    return os.path.splitext(os.path.basename(infile))[0]+".out"
+
+def run_endf(infile, outfile=None):
+    infile = endf_source(infile)
+    out, step = infile, 1
     if outfile is None:
-        outfile = os.path.splitext(os.path.basename(infile))[0]+".out"
-    if os.path.exists(outfile):
-        print(f"{outfile} already exists...skipping")
-        return
+        outfile = default_outfile(infile)
     if infile.endswith('.zip'):
         out = "STEP-0.OUT"
         zipname = expand_zip(infile)
         os.rename(zipname,out)
-    out,step = linear(out, step)  # must be first
-    out,step = recent(out, step)  # add resonances
-    out,step = sigma1(out, step, 293.16) # set temperature to 20 C
-    out,step = activate(out, step)
-    #out,step = legend(out, step)
-    #out,step = sixpak(out, step)
-    #out,step = spectra(out, step)
-    out,step = fixup(out, step)
-    out,step = dictin(out, step)
-    os.rename(out, outfile)
+    for name, params in PIPELINE:
+        out,step = globals()[name](out, step, **params)
+    os.replace(out, outfile)
     for step in (0, 1):
         if os.path.exists(f"STEP-{step}.OUT"):
            os.unlink(f"STEP-{step}.OUT")
     return outfile
 
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fid:
+        for block in iter(lambda: fid.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def program_sha256(prog):
+    """Hash of the PREPRO program *prog*, or None if it is not installed."""
+    path = os.path.join(ENDF_PROGRAMS, prog)
+    return file_sha256(path) if os.path.exists(path) else None
+
+def pipeline_recipe():
+    """
+    Description of the processing done by run_endf for the build manifest.
+
+    This lists each step in PIPELINE with its parameters, a hash of the
+    input deck the step writes (which holds the fixed tolerances and error
+    laws), and a hash of the PREPRO program.  The deck is generated with
+    placeholder file names so that it is the same for every isotope.
+    """
+    steps = []
+    for name, params in PIPELINE:
+        deck = globals()[name + "_input"]("INFILE", "OUTFILE", **params)
+        steps.append({
+            "step": name,
+            "params": params,
+            "input": hashlib.sha256(deck.encode("utf-8")).hexdigest(),
+            "program": program_sha256(name),
+        })
+    # Round trip through json so it compares equal to the saved version.
+    return json.loads(json.dumps(steps))
+
+class BuildManifest:
+    """
+    Record of the outputs built by cmd_interp, stored as json in *path*.
+
+    Each output is keyed by file name and records its input file, the
+    input hash, the pipeline recipe (see pipeline_recipe) and the size and
+    modification time of the output when it was completed.  The input hash
+    is only recomputed if the input size or modification time changes.
+    """
+    def __init__(self, path=MANIFEST):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as fid:
+                self.entries = json.load(fid).get("outputs", {})
+
+    def input_sha256(self, infile, outfile):
+        stat = os.stat(infile)
+        entry = self.entries.get(outfile, {}).get("input", {})
+        if entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return entry["sha256"]
+        return file_sha256(infile)
+
+    def is_current(self, infile, outfile, recipe):
+        """True if *outfile* was completed from the current *infile* and *recipe*."""
+        entry = self.entries.get(outfile)
+        if entry is None or not os.path.exists(outfile):
+            return False
+        stat = os.stat(outfile)
+        return (
+            entry["output"] == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            and entry["steps"] == recipe
+            and entry["input"]["sha256"] == self.input_sha256(infile, outfile))
+
+    def record(self, infile, outfile, recipe):
+        """Record that *outfile* was built from *infile* using *recipe*."""
+        in_stat, out_stat = os.stat(infile), os.stat(outfile)
+        self.entries[outfile] = {
+            "input": {
+                "path": os.path.abspath(infile),
+                "sha256": self.input_sha256(infile, outfile),
+                "size": in_stat.st_size,
+                "mtime_ns": in_stat.st_mtime_ns,
+            },
+            "steps": recipe,
+            "output": {"size": out_stat.st_size, "mtime_ns": out_stat.st_mtime_ns},
+            "built": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+        self.save()
+
+    def save(self):
+        # Write and rename so an interrupted save keeps the old manifest.
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fid:
+            json.dump({"outputs": self.entries}, fid, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def run_endf_isolated(infile, outfile):
+    """
+    Run run_endf on *infile* in a new scratch directory next to *outfile*,
+    then move the result to *outfile*.
+
+    The output of the PREPRO programs goes to RUN.LOG in the scratch
+    directory.  The scratch directory is removed on success.  On failure
+    it is kept, and the RuntimeError raised gives its location.
+
+    This changes the working directory and redirects stdout while it runs,
+    so it must be called in a process of its own, as in cmd_interp.
+    """
+    infile, outfile = os.path.abspath(infile), os.path.abspath(outfile)
+    name = os.path.basename(outfile)
+    scratch = tempfile.mkdtemp(prefix=f".{name}-", dir=os.path.dirname(outfile))
+    cwd = os.getcwd()
+    saved = os.dup(1), os.dup(2)
+    try:
+        with open(os.path.join(scratch, "RUN.LOG"), "w") as log:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                os.chdir(scratch)
+                run_endf(infile, name)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                os.chdir(cwd)
+        # Same file system, so the output appears complete or not at all.
+        os.replace(os.path.join(scratch, name), outfile)
+    except Exception as e:
+        raise RuntimeError(f"{e} (see {scratch})") from None
+    finally:
+        os.close(saved[0])
+        os.close(saved[1])
+    if not KEEP_INTERMEDIATES:
+        shutil.rmtree(scratch)
+    return outfile
+
 def first_resonance(table, col):
     # 20 A => 0.2 meV; 0.1 A => 8180 meV
     # Arcs: 1500, Sequoia: 2000, Vision: 1000, Powgen, Nomad: 8180
@@ -743,7 +1258,12 @@ def abundance(filename, xs=-1):
     except KeyError:
         return 0
 
-def cmd_show_interp(files, plot=True):
+def cmd_show_interp(files, plot=True, store=None):
+    """
+    Show the cross sections from the ENDF output *files*.  If *store* is
+    an XSStore then files which are in the store are read from it, and
+    if no files are given then all isotopes in the store are shown.
+    """
     import sys
     # TODO: Convert runtime flags into command line options
     #x_data = "energy"
@@ -771,6 +1291,9 @@ def cmd_show_interp(files, plot=True):
         print("Need periodictable to evaluate isotope abundance")
         sys.exit(1)
 
+    if store is not None and not files:
+        files = list(store)
+
     for f in files:
         #if '*' in f or "-O-" in f:
         #    print(f"no data for {f}")
@@ -778,7 +1301,7 @@ def cmd_show_interp(files, plot=True):
         p = abundance(f)
         if (common_only and p < 0.1) or (natural_only and p <=0):
             continue
-        table = xs_table(f, columns)
+        table = xs_table(f, columns, store=store)
         #save_table(os.path.splitext(f)[0]+".tab", table, range=(1e0,1e2))
         if table is not None:
             # Only plot isotopes with thermal resonance
@@ -793,13 +1316,186 @@ def cmd_show_interp(files, plot=True):
     if plot and LINENUM >= 0:
         showplot(x_data, y_data)
 
-def cmd_interp(files):
-    """Convert endf data to plottable columns"""
+def cmd_interp(files, jobs=1):
+    """
+    Convert endf data to plottable columns
+
+    Outputs which are up to date in the build manifest are skipped.
+
+    With *jobs* > 1 the files are processed in a pool of worker processes,
+    each isotope in its own scratch directory (see run_endf_isolated).
+    *jobs* = 0 uses one worker per cpu.  A failed isotope does not stop
+    the others.  Failures are summarized at the end.
+    """
+    manifest = BuildManifest()
+    recipe = pipeline_recipe()
+    failures = []
+    tasks = []
+    processed = 0
     for f in files:
         try:
-            run_endf(f)
+            infile = endf_source(f)
+            outfile = default_outfile(infile)
+            if manifest.is_current(infile, outfile, recipe):
+                print(f"{outfile} is up to date...skipping")
+                continue
         except Exception as e:
-            print(f"when processing {f}:\n   {e}")
+            failures.append((f, str(e)))
+            continue
+        tasks.append((f, infile, outfile))
+
+    if jobs == 1:
+        for done, (f, infile, outfile) in enumerate(tasks, 1):
+            try:
+                run_endf(infile, outfile)
+                manifest.record(infile, outfile, recipe)
+                endf_index(outfile)
+                processed += 1
+                print(f"[{done}/{len(tasks)}] {f}")
+            except Exception as e:
+                failures.append((f, str(e)))
+                print(f"[{done}/{len(tasks)}] {f} FAILED")
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            futures = {
+                pool.submit(run_endf_isolated, infile, outfile): (f, infile, outfile)
+                for f, infile, outfile in tasks}
+            for done, future in enumerate(as_completed(futures), 1):
+                f, infile, outfile = futures[future]
+                try:
+                    future.result()
+                    manifest.record(infile, outfile, recipe)
+                    endf_index(outfile)
+                    processed += 1
+                    print(f"[{done}/{len(tasks)}] {f}")
+                except Exception as e:
+                    failures.append((f, str(e)))
+                    print(f"[{done}/{len(tasks)}] {f} FAILED")
+    print(f"processed {processed} of {len(files)} files,"
+          f" {len(failures)} failed")
+    for f, msg in failures:
+        print(f"when processing {f}:\n   {msg}")
+
+def _tab1_lines(mat, mt, x, y, nr=1):
+    """
+    Lines of an MF=3 section holding the TAB1 record (*x*, *y*) written
+    with an "E" exponent, with *nr* interpolation regions, for self_test.
+    """
+    def record(fields, seq):
+        return "".join(fields).ljust(66) + f"{mat:4d} 3{mt:3d}{seq:5d}\n"
+    ints = lambda v: [f"{k:11d}" for k in v]
+    floats = lambda v: [f"{k:11.4E}" for k in v]
+    np_ = len(x)
+    regions = [(np_*(k+1))//nr for k in range(nr)]
+    lines = [floats([1001., 0.99917]) + ints([0, 0, 0, 0]),
+             floats([0., 0.]) + ints([0, 0, nr, np_])]
+    table = [v for nbt in regions for v in (nbt, 2)]
+    lines += [ints(table[k:k+6]) for k in range(0, len(table), 6)]
+    data = [v for pair in zip(x, y) for v in pair]
+    lines += [floats(data[k:k+6]) for k in range(0, len(data), 6)]
+    lines = [record(fields, seq) for seq, fields in enumerate(lines, 1)]
+    lines.append(f"{'':66}{mat:4d} 3  0{99999:5d}\n")
+    return lines
+
+def self_test():
+    """
+    Check endf_floats on examples of ENDF number formats, and check that
+    endf_read_tab1, endf_read1d, endf_load and endf_scan agree on TAB1
+    records written with an "E" exponent, so that float() can read them.
+    """
+    examples = {
+        " 1.234567+5": 1.234567e5, "-1.234567-5": -1.234567e-5,
+        " 2.530000-2": 2.53e-2, " 1.00000+ 0": 1.0, " 1.00000- 2": 1e-2,
+        " 1.0000E+05": 1e5, "-3.5e-3    ": -3.5e-3, " 123456.789": 123456.789,
+        " 0.00000+00": 0.0, "          0": 0.0, "-1.23456789": -1.23456789,
+        " 1.23456+10": 1.23456e10, "1.234567890": 1.23456789,
+    }
+    fields = np.array(list(examples), dtype="S11")
+    for text, value in zip(examples, endf_floats(fields)):
+        assert value == examples[text], f"endf_floats({text!r}) = {value!r}"
+
+    # Sections with 1, 2 and 3 pairs on the final line, and interpolation
+    # tables on one and two lines.  endf_read1d assumes a single line of
+    # interpolation regions, so it is only compared for those.
+    rng = np.random.default_rng(1)
+    cases = [(1, 1), (2, 1), (3, 1), (4, 2), (5, 3), (6, 4), (100, 5)]
+    lines, expected = [], {}
+    for mt, (n, nr) in enumerate(cases, 1):
+        x = np.sort(rng.uniform(1e-5, 2e7, n))
+        y = rng.uniform(-50, 5e4, n) * 10.**rng.integers(-8, 3, n)
+        section = _tab1_lines(125, mt, x, y, nr)
+        head, body = section[0], "".join(section[1:])
+        x, y = (np.array([float(f"{v:11.4E}") for v in a]) for a in (x, y))
+        new = endf_read_tab1(head, io.StringIO(body))
+        assert np.array_equal(new[0], x) and np.array_equal(new[1], y), f"MT={mt}"
+        if nr <= 3:
+            old = endf_read1d(head, io.StringIO(body))
+            assert np.array_equal(new[0], old[0]) and np.array_equal(new[1], old[1]), f"MT={mt}"
+        lines += section
+        expected[(125, 3, mt)] = x, y
+
+    # The same sections from a file, with and without the section index.
+    columns = [f" 3{mt:3d}" for mt in range(1, len(cases)+1)]
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, "n_001-H-1_0125.out")
+        with open(filename, "w") as fid:
+            fid.write(f"{' synthetic':66}   1 0  0    0\n")
+            fid.writelines(lines)
+        for result in (endf_scan(filename, columns), endf_load(filename, columns)):
+            assert result.keys() == expected.keys()
+            for key, (x, y) in expected.items():
+                assert np.array_equal(result[key][0], x) and np.array_equal(result[key][1], y), key
+        assert os.path.exists(filename + ".idx")
+    print(f"self test passed: {len(examples)} number formats, {len(cases)} sections")
+
+def cmd_check_reader(files):
+    """
+    Check endf_read_tab1 against endf_read1d for all MF=3 sections in
+    *files*.  Returns the number of failures, including files with no
+    sections which endf_read1d can read.
+    """
+    failed = 0
+    for f in files:
+        sections, points, skipped = 0, 0, 0
+        old_time = new_time = 0.
+        with open(f) as fid:
+            offsets = []
+            while True:
+                pos = fid.tell()
+                line = fid.readline()
+                if line == "": break
+                if line[70:72] == " 3" and line[72:75] != "  0" and line[75:80] != "99999":
+                    offsets.append(pos)
+                    endf_read_tab1(line, fid)
+            for pos in offsets:
+                fid.seek(pos)
+                head = fid.readline()
+                start = time.perf_counter()
+                x, y = endf_read_tab1(head, fid)
+                new_time += time.perf_counter() - start
+                fid.seek(pos)
+                head = fid.readline()
+                start = time.perf_counter()
+                try:
+                    x0, y0 = endf_read1d(head, fid)
+                except ValueError:
+                    # endf_read1d uses float(), which needs an "E" exponent.
+                    skipped += 1
+                    continue
+                old_time += time.perf_counter() - start
+                sections += 1
+                points += len(x)
+                if not (np.array_equal(x, x0) and np.array_equal(y, y0)):
+                    print(f"{f} MT={head[72:75].strip()}: readers differ")
+                    failed += 1
+        print(f"{f}: {sections} sections, {points} points match;"
+              f" {skipped} not readable by endf_read1d;"
+              f" {old_time:.3f}s -> {new_time:.3f}s")
+        if sections == 0:
+            print(f"{f}: nothing compared")
+            failed += 1
+    return failed
 
 def cmd_endf_plot(files):
     """plot using endf program"""
@@ -813,8 +1509,24 @@ if __name__ == "__main__":
         cmd_endf_plot(sys.argv[2:])
     elif sys.argv[1] in ("--table", "--noplot", "--pyplot", "--plot"):
         plot = sys.argv[1] in ("--pyplot", "--plot")
-        cmd_show_interp(sys.argv[2:], plot=plot)
+        args, store = sys.argv[2:], None
+        if args and args[0] == "--store":
+            store, args = XSStore(args[1]), args[2:]
+        cmd_show_interp(args, plot=plot, store=store)
+    elif sys.argv[1] == "--build-store":
+        args, path = sys.argv[2:], STORE
+        if args and args[0] == "--store":
+            path, args = args[1], args[2:]
+        isotopes = build_store(args, path)
+        print(f"wrote {len(isotopes)} isotopes to {path}.dat and {path}.json")
+    elif sys.argv[1] == "--self-test":
+        self_test()
+    elif sys.argv[1] == "--check-reader":
+        sys.exit(1 if cmd_check_reader(sys.argv[2:]) else 0)
     elif sys.argv[1] == "--interp":
-        cmd_interp(sys.argv[2:])
+        args, jobs = sys.argv[2:], 1
+        if args and args[0] in ("--jobs", "-j"):
+            jobs, args = int(args[1]), args[2:]
+        cmd_interp(args, jobs=jobs)
     else:
         cmd_show_interp(sys.argv[1:], plot=True)
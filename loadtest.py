@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Load test for the activation calculator web server.
+
+Usage: python loadtest.py [--mode cgi|app|pool] [--concurrency N]
+                          [--duration SECONDS] [--mix nact=8,massfrac=1,static=1]
+
+Starts server.py on a free localhost port in the given mode, waits for it
+to answer, then sends requests from --concurrency client threads for
+--duration seconds.  Each request is chosen at random from the --mix of
+nact.py calculations (the samples from the benchmark corpus), massfrac.py
+calculations and static files from the activation directory.  The server
+is stopped at the end of the run.
+
+Modes are "cgi" (a new python process per request, as under apache),
+"app" (server.py --app) and "pool" (server.py --workers N, with --workers N
+to set the pool size, default one per cpu).  Other server options can be
+passed with --server-arg, or use --url to test a server which is already
+running.
+
+The report gives the throughput, latency percentiles for each kind of
+request, the error rate and the number of requests rejected with
+"503 Service Unavailable" because the server queue was full.  Use --json
+to save the report for comparison between modes or versions.
+
+Nact requests repeat the same few samples, so an in-process server will
+mostly answer them from its result cache.  Use --vary to give each
+request a different mass so that every request is calculated.
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import json
+import random
+import socket
+import signal
+import threading
+import subprocess
+from collections import OrderedDict
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode, urlsplit
+except ImportError:
+    from httplib import HTTPConnection
+    from urllib import urlencode
+    from urlparse import urlsplit
+
+from benchmark import CORPUS, percentile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MODES = {
+    "cgi": [],
+    "app": ["--app"],
+    "pool": ["--workers"],
+}
+
+STATIC = [
+    "/activation/index.html",
+    "/activation/jquery-3.7.1.min.js",
+    "/activation/figure_1.png",
+]
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def nact_request(counter, vary):
+    _, fields = random.choice(CORPUS)
+    fields = dict(fields)
+    if vary:
+        fields["mass"] = "%.9gg" % (1 + next(counter)*1e-6)
+    body = urlencode(fields, doseq=True)
+    return "POST", "/cgi-bin/nact.py", body
+
+def massfrac_request(counter, vary):
+    _, fields = random.choice(CORPUS)
+    return "GET", "/cgi-bin/massfrac.py?" + urlencode({"sample": fields["sample"]}), None
+
+def static_request(counter, vary):
+    return "GET", random.choice(STATIC), None
+
+REQUESTS = OrderedDict([
+    ("nact", nact_request),
+    ("massfrac", massfrac_request),
+    ("static", static_request),
+])
+
+def send(host, port, method, path, body=None, timeout=60):
+    """
+    Send a request, returning (status, seconds).
+
+    Calculator responses with status 200 which are not successful JSON
+    results are returned with status None.  This catches cgi scripts which
+    fail after the server has already sent the status line.
+    """
+    headers = {}
+    if body is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    start = time.perf_counter()
+    conn = HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        content = response.read()
+        status = response.status
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    if status == 200 and path.startswith("/cgi-bin/"):
+        try:
+            if not json.loads(content.decode("utf-8")).get("success", False):
+                status = None
+        except ValueError:
+            status = None
+    return status, elapsed
+
+def wait_for_server(host, port, process=None, timeout=120):
+    """Wait until the server answers a calculation request."""
+    deadline = time.time() + timeout
+    failures = 0
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("server exited with status %d" % process.returncode)
+        try:
+            status, _ = send(host, port, "GET", "/cgi-bin/nact.py?sample=Co", timeout=timeout)
+        except (OSError, socket.error):
+            # Not listening yet.
+            status = 0
+        if status == 200:
+            return
+        if status != 0:
+            failures += 1
+            if failures >= 3:
+                raise RuntimeError("server is running but the calculation failed")
+        time.sleep(0.2)
+    raise RuntimeError("server did not start within %g s" % timeout)
+
+def start_server(mode, workers=None, extra_args=(), log=None):
+    """Start server.py on a free port, returning (process, port)."""
+    port = free_port()
+    args = list(MODES[mode])
+    if mode == "pool":
+        args.append(str(workers or 0))
+    args.extend(extra_args)
+    cmd = [sys.executable, os.path.join(ROOT, "server.py")] + args + ["localhost:%d" % port]
+    output = open(log, "w") if log else subprocess.DEVNULL
+    process = subprocess.Popen(cmd, cwd=ROOT, stdout=output, stderr=subprocess.STDOUT)
+    return process, port
+
+def stop_server(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM if hasattr(signal, "SIGTERM") else signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def run_load(host, port, mix, concurrency=8, duration=10., vary=False):
+    """
+    Send requests chosen from *mix* ({kind: weight}) from *concurrency*
+    threads for *duration* seconds.  Returns [(kind, status, seconds)],
+    with status None for requests which failed without a response.
+    """
+    import itertools
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    counter = itertools.count()
+    records = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        local = []
+        while time.perf_counter() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            method, path, body = REQUESTS[kind](counter, vary)
+            start = time.perf_counter()
+            try:
+                status, elapsed = send(host, port, method, path, body)
+            except Exception:
+                status, elapsed = None, time.perf_counter() - start
+            local.append((kind, status, elapsed))
+        with lock:
+            records.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - start
+
+def summarize(records, elapsed):
+    """Throughput, latency percentiles and error counts for *records*."""
+    def stats(subset):
+        ok = [seconds for _, status, seconds in subset if status == 200]
+        rejected = sum(1 for _, status, _ in subset if status == 503)
+        errors = len(subset) - len(ok) - rejected
+        return OrderedDict([
+            ("requests", len(subset)),
+            ("throughput", len(ok)/elapsed if elapsed else None),
+            ("p50", percentile(ok, 50)),
+            ("p95", percentile(ok, 95)),
+            ("p99", percentile(ok, 99)),
+            ("errors", errors),
+            ("error_rate", errors/len(subset) if subset else 0.),
+            ("rejected", rejected),
+        ])
+    report = OrderedDict([("elapsed", elapsed), ("total", stats(records))])
+    report["kinds"] = OrderedDict(
+        (kind, stats([r for r in records if r[0] == kind]))
+        for kind in REQUESTS if any(r[0] == kind for r in records))
+    return report
+
+def print_report(report):
+    ms = lambda v: "%8.1f" % (1e3*v) if v is not None else "%8s" % "-"
+    print("%-10s %8s %8s %8s %8s %8s %7s %8s" % (
+        "kind", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "rejected"))
+    rows = [("total", report["total"])] + list(report["kinds"].items())
+    for name, stats in rows:
+        print("%-10s %8d %8.1f %s %s %s %7d %8d" % (
+            name, stats["requests"], stats["throughput"], ms(stats["p50"]),
+            ms(stats["p95"]), ms(stats["p99"]), stats["errors"], stats["rejected"]))
+
+def parse_mix(text):
+    mix = OrderedDict()
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in REQUESTS:
+            raise ValueError("unknown request kind %r in mix" % kind)
+        mix[kind] = float(weight) if weight else 1.
+    return mix
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Load test the activation calculator server.")
+    parser.add_argument("--mode", choices=sorted(MODES), default="app",
+        help="server mode to start (default app)")
+    parser.add_argument("--workers", type=int,
+        help="number of workers in pool mode (default one per cpu)")
+    parser.add_argument("--server-arg", action="append", default=[],
+        help="extra argument for server.py, may be repeated")
+    parser.add_argument("--url",
+        help="test the server running at this url instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=8,
+        help="number of concurrent clients (default 8)")
+    parser.add_argument("--duration", type=float, default=10.,
+        help="length of the test in seconds (default 10)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("nact=8,massfrac=1,static=1"),
+        help="relative weights of request kinds (default nact=8,massfrac=1,static=1)")
+    parser.add_argument("--vary", action="store_true",
+        help="use a different mass in each nact request to avoid the result cache")
+    parser.add_argument("--log", help="file for the server output")
+    parser.add_argument("--json", help="file for the JSON report")
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        process, port = start_server(args.mode, args.workers, args.server_arg, args.log)
+        host = "localhost"
+    try:
+        wait_for_server(host, port, process)
+        records, elapsed = run_load(host, port, args.mix, args.concurrency,
+                                    args.duration, args.vary)
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    report = summarize(records, elapsed)
+    report["settings"] = OrderedDict([
+        ("mode", args.url or args.mode),
+        ("workers", args.workers),
+        ("concurrency", args.concurrency),
+        ("duration", args.duration),
+        ("mix", args.mix),
+        ("vary", args.vary),
+    ])
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(report, fd, indent=2)
+            fd.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -7,15 +7,46 @@ not recommended for a public facing server.  The activation calculator
 expects a cgi interface, which should be provided by the web infrastructure
 (apache, nginx, etc.) that you are using on your production server.
 
-Usage: python server.py [host | host:port]
+Usage: python server.py [--app] [--workers N] [host | host:port]
 
 Default is localhost:8008
+
+By default each request to a script in cgi-bin starts a new python
+interpreter, the same as it would under apache.  With --app the calculator
+scripts (nact.py and massfrac.py) are imported once at startup, their data
+tables are loaded, and requests are sent straight to their cgi_call
+functions.  The other cgi-bin scripts still run as cgi.
+
+The in-process calculator is also available as the WSGI application
+*application* in this file, so it can be hosted by any WSGI server::
+
+    gunicorn --chdir /path/to/activation server:application
+
+With --workers N the server runs the calculator in a pool of N pre-forked
+worker processes, or one per cpu if N is 0.  Each worker imports and warms
+the calculator before taking requests, then serves requests in-process as
+with --app.  The main process accepts connections and passes them to the
+workers, returning "503 Service Unavailable" when more than --max-queue
+requests are waiting.  Workers are replaced after --max-requests requests
+to bound memory use.  Send SIGHUP to the main process for a graceful
+restart, which starts a new set of workers, reloading the calculator code,
+and retires the old workers once the new ones are ready.  The worker pool
+requires a unix system.
+
+When the calculator runs in-process (--app, --workers or WSGI), the time
+spent in each stage of the calculation and the request counts are served
+in the Prometheus text format at /metrics.  The metrics are kept by each
+process, so with --workers a scrape reports the worker that answered it.
 """
 
 from __future__ import print_function
 
 import sys
 import os
+import time
+import signal
+import socket
+import traceback
 try:
     from http.server import HTTPServer, CGIHTTPRequestHandler
     from socketserver import ThreadingMixIn
@@ -26,20 +57,374 @@ except ImportError:
 import cgitb
 cgitb.enable()  ## This line enables CGI error reporting
 
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CGI_BIN = os.path.join(ROOT, "cgi-bin")
+
+# Scripts which can be run in-process, with the module that implements them.
+APP_SCRIPTS = {
+    "/cgi-bin/nact.py": "nact",
+    "/cgi-bin/massfrac.py": "massfrac",
+}
+METRICS_PATH = "/metrics"
+_apps = {}
+
+def load_apps(warmup=True):
+    """
+    Import the calculator scripts from cgi-bin, optionally loading the
+    periodictable data tables so the first request is not delayed.
+    """
+    if not _apps:
+        import importlib
+        if CGI_BIN not in sys.path:
+            sys.path.insert(0, CGI_BIN)
+        for path, name in APP_SCRIPTS.items():
+            _apps[path] = importlib.import_module(name)
+        if warmup:
+            _apps["/cgi-bin/nact.py"].warmup()
+    return _apps
+
+def application(environ, start_response):
+    """
+    WSGI entry point for the calculator scripts.
+    """
+    import cgi
+    if environ.get("PATH_INFO", "") == METRICS_PATH:
+        body = load_apps()["/cgi-bin/nact.py"].metrics.prometheus().encode("utf-8")
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ])
+        return [body]
+    module = load_apps().get(environ.get("PATH_INFO", ""))
+    if module is None:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not found\n"]
+    form = cgi.FieldStorage(fp=environ["wsgi.input"], environ=environ)
+    if getattr(module, "wants_stream", None) and module.wants_stream(form):
+        # Newline-delimited JSON is sent a line at a time as it is computed.
+        start_response("200 OK", [
+            ("Content-Type", "application/x-ndjson; charset=UTF-8"),
+            ("Access-Control-Allow-Origin", "*"),
+        ])
+        return (line.encode("utf-8") for line in module.stream_request(form))
+    body = (module.json_encode(module.handle_request(form)) + "\n").encode("utf-8")
+    start_response("200 OK", [
+        ("Content-Type", "application/json; charset=UTF-8"),
+        ("Access-Control-Allow-Origin", "*"),
+        ("Content-Length", str(len(body))),
+    ])
+    return [body]
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Very simple threaded server"""
     allow_reuse_address = True
     request_queue_size = 50
 
-server = ThreadedHTTPServer
-handler = CGIHTTPRequestHandler
-handler.cgi_directories = ["/cgi-bin"]
+class AppHTTPRequestHandler(CGIHTTPRequestHandler):
+    """
+    Request handler which sends the calculator scripts to *application*
+    instead of running them as cgi.
+    """
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == METRICS_PATH:
+            self.run_app(METRICS_PATH)
+        else:
+            CGIHTTPRequestHandler.do_GET(self)
+
+    def run_cgi(self):
+        path = self.path.split("?", 1)[0]
+        if path in APP_SCRIPTS:
+            self.run_app(path)
+        else:
+            CGIHTTPRequestHandler.run_cgi(self)
+
+    def run_app(self, path):
+        query = self.path.split("?", 1)[1] if "?" in self.path else ""
+        environ = {
+            "REQUEST_METHOD": self.command,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": self.headers.get("content-type", ""),
+            "CONTENT_LENGTH": self.headers.get("content-length", "0"),
+            "REMOTE_ADDR": self.client_address[0],
+            "SERVER_PROTOCOL": self.protocol_version,
+            "wsgi.input": self.rfile,
+            "wsgi.errors": sys.stderr,
+            "wsgi.url_scheme": "http",
+        }
+        def start_response(status, headers, exc_info=None):
+            code, _, reason = status.partition(" ")
+            self.send_response(int(code), reason)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            return self.wfile.write
+        for chunk in application(environ, start_response):
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+class PreforkServer(object):
+    """
+    HTTP server with a pool of pre-forked worker processes.
+
+    The main process owns the listening socket.  Accepted connections are
+    sent to the workers over a unix datagram socket shared by all workers,
+    so each connection is taken by the next idle worker.  The number of
+    connections sent but not yet completed is kept in shared memory so that
+    the main process can refuse new connections when the pool is saturated.
+    Each worker also flags the connection it is handling, so that if it
+    dies part way through a request the connection is no longer counted.
+    """
+    def __init__(self, address, workers=None, max_requests=1000, max_queue=50):
+        self.address = address
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.max_queue = max_queue
+        self.children = {}  # pid => generation
+        self.slots = {}  # pid => index into self.taken
+        self.generation = 0
+        self.running = False
+        self.restart_requested = False
+        self.restart_started = None
+
+    def serve_forever(self):
+        import multiprocessing
+        self.pending = multiprocessing.Value('i', 0)
+        self.ready = multiprocessing.Value('i', 0)
+        # Old and new workers overlap during a restart.
+        self.taken = multiprocessing.Array('i', 2*self.workers, lock=False)
+        self.jobs, self.worker_jobs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.listener = socket.create_server(
+            self.address, backlog=self.workers + self.max_queue)
+        self.listener.settimeout(0.5)
+
+        signal.signal(signal.SIGHUP, self._request_restart)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        self.running = True
+        self._spawn_all()
+        try:
+            while self.running:
+                self._accept()
+                self._reap()
+                if self.restart_requested:
+                    self._start_restart()
+                if self.restart_started is not None:
+                    self._finish_restart()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.listener.close()
+            self._stop_workers(list(self.children))
+            while self.children:
+                self._reap(block=True)
+
+    def _request_restart(self, signum, frame):
+        self.restart_requested = True
 
-if len(sys.argv) > 1:
-    host, *rest = sys.argv[1].split(':', 1)
+    def _request_stop(self, signum, frame):
+        self.running = False
+
+    def _accept(self):
+        try:
+            conn, addr = self.listener.accept()
+        except socket.timeout:
+            return
+        except OSError:
+            # Interrupted by a signal or a transient accept failure.
+            return
+        try:
+            if self.pending.value >= self.workers + self.max_queue:
+                self._busy(conn)
+                return
+            with self.pending.get_lock():
+                self.pending.value += 1
+            try:
+                socket.send_fds(self.jobs, [b"c"], [conn.fileno()])
+            except OSError:
+                with self.pending.get_lock():
+                    self.pending.value -= 1
+                raise
+        finally:
+            # The worker holds its own copy of the connection.
+            conn.close()
+
+    def _busy(self, conn):
+        body = b"Server busy, try again later\n"
+        try:
+            conn.sendall(
+                b"HTTP/1.0 503 Service Unavailable\r\n"
+                b"Content-Type: text/plain\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body) + body)
+            # Read whatever the client has sent before closing, otherwise the
+            # unread request causes a reset which can discard the response.
+            conn.shutdown(socket.SHUT_WR)
+            conn.settimeout(0.05)
+            while conn.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    def _spawn_all(self):
+        for _ in range(self.workers):
+            self._spawn()
+
+    def _spawn(self):
+        # If restarts overlap there may be no free slot, and the worker
+        # is not tracked.
+        used = set(self.slots.values())
+        slot = next((k for k in range(len(self.taken)) if k not in used), None)
+        if slot is not None:
+            self.taken[slot] = 0
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self.listener.close()
+                self.jobs.close()
+                worker_main(self.worker_jobs, self.pending, self.ready,
+                            self.max_requests, self.taken, slot)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = self.generation
+        if slot is not None:
+            self.slots[pid] = slot
+
+    def _reap(self, block=False):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            slot = self.slots.pop(pid, None)
+            if slot is not None:
+                # Release the connection of a worker which died mid-request.
+                with self.pending.get_lock():
+                    if self.taken[slot]:
+                        self.taken[slot] = 0
+                        self.pending.value -= 1
+            # Replace workers from the current generation which have been
+            # recycled or have died.
+            if self.running and generation == self.generation:
+                self._spawn()
+            if block:
+                return
+
+    def _start_restart(self):
+        self.restart_requested = False
+        print("restarting workers...")
+        with self.ready.get_lock():
+            self.ready.value = 0
+        self.generation += 1
+        self.restart_started = time.time()
+        self._spawn_all()
+
+    def _finish_restart(self):
+        # Retire the old workers once the new ones are warm.  If the new
+        # workers fail to start the old ones are kept until the timeout.
+        if (self.ready.value < self.workers
+                and time.time() - self.restart_started < 120):
+            return
+        self.restart_started = None
+        self._stop_workers(pid for pid, generation in self.children.items()
+                           if generation != self.generation)
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+def worker_main(jobs, pending, ready, max_requests, taken, slot):
+    """
+    Worker process for :class:`PreforkServer`.
+
+    Loads and warms the calculator then handles connections received on
+    *jobs* until *max_requests* have been served or the worker is asked to
+    stop with SIGTERM.  The request in progress is always completed.
+    *taken[slot]* is set while the worker is handling a connection.
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+
+    load_apps()
+    with ready.get_lock():
+        ready.value += 1
+
+    AppHTTPRequestHandler.cgi_directories = ["/cgi-bin"]
+    httpd = HTTPServer(("", 0), AppHTTPRequestHandler, bind_and_activate=False)
+    httpd.server_name, httpd.server_port = socket.getfqdn(), 0
+    jobs.settimeout(1.0)
+    served = 0
+    while not stopping and served < max_requests and os.getppid() == parent:
+        try:
+            _, fds, _, _ = socket.recv_fds(jobs, 16, 1)
+        except (socket.timeout, InterruptedError):
+            continue
+        if not fds:
+            continue
+        if slot is not None:
+            taken[slot] = 1
+        conn = socket.socket(fileno=fds[0])
+        try:
+            httpd.finish_request(conn, conn.getpeername())
+        except Exception:
+            traceback.print_exc()
+        finally:
+            httpd.shutdown_request(conn)
+            with pending.get_lock():
+                pending.value -= 1
+                if slot is not None:
+                    taken[slot] = 0
+            served += 1
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Server for testing the neutron activation calculator.")
+    parser.add_argument("address", nargs="?", default="",
+        help="host or host:port to serve on (default localhost:8008)")
+    parser.add_argument("--app", action="store_true",
+        help="run the calculator in-process rather than as cgi")
+    parser.add_argument("--workers", type=int, metavar="N",
+        help="serve from a pool of N pre-forked workers (0 for one per cpu)")
+    parser.add_argument("--max-requests", type=int, default=1000,
+        help="requests served by a worker before it is replaced")
+    parser.add_argument("--max-queue", type=int, default=50,
+        help="waiting requests allowed before returning 503")
+    args = parser.parse_args()
+
+    host, *rest = args.address.split(':', 1)
     port = int(rest[0]) if rest else 8008
-else:
-    host, port = "", 8008
-print(f"serving on http://{host}:{port}/activation/")
-httpd = server((host, port), handler)
-httpd.serve_forever()
+    if args.workers is not None:
+        httpd = PreforkServer((host, port), workers=args.workers,
+                              max_requests=args.max_requests,
+                              max_queue=args.max_queue)
+        print(f"serving on http://{host}:{port}/activation/ with {httpd.workers} workers")
+        httpd.serve_forever()
+        return
+
+    server = ThreadedHTTPServer
+    handler = AppHTTPRequestHandler if args.app else CGIHTTPRequestHandler
+    handler.cgi_directories = ["/cgi-bin"]
+    if args.app:
+        print("loading calculator tables...")
+        load_apps()
+    print(f"serving on http://{host}:{port}/activation/")
+    httpd = server((host, port), handler)
+    httpd.serve_forever()
+
+if __name__ == "__main__":
+    main()